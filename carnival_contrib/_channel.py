@@ -0,0 +1,168 @@
+"""
+Потоковая передача данных через stdin/stdout удаленной команды
+
+Вся передача идет по одному ssh-каналу, без сессии sftp и без временных файлов на стороне отправителя.
+"""
+
+import threading
+import typing
+
+from carnival import Connection
+
+
+BUFSIZE = 256 * 1024
+
+
+class ChannelResult(typing.NamedTuple):
+    """
+    Результат выполнения команды в канале
+    """
+
+    return_code: int
+    stdout: bytes
+    stderr: bytes
+
+    @property
+    def ok(self) -> bool:
+        return self.return_code == 0
+
+
+class ChannelWriter:
+    """
+    Файлоподобный объект, который пишет в stdin удаленной команды
+    """
+
+    def __init__(self, channel: typing.Any) -> None:
+        self.channel = channel
+        self.closed_by_peer = False
+        self.bytes_written = 0
+
+    def write(self, data: bytes) -> int:
+        if self.closed_by_peer:
+            return len(data)
+        try:
+            self.channel.sendall(data)
+        except OSError:
+            # Remote command exited early, its exit code and stderr explain why
+            self.closed_by_peer = True
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+def _open_channel(c: Connection, command: str) -> typing.Any:
+    # TODO: c._c ;(
+    c._c.open()  # type: ignore
+    channel = c._c.transport.open_session()  # type: ignore
+    channel.exec_command(command)
+    return channel
+
+
+def _drain(recv: typing.Callable[[int], bytes], chunks: typing.List[bytes]) -> None:
+    while True:
+        data = recv(BUFSIZE)
+        if not data:
+            return
+        chunks.append(data)
+
+
+def _start_drain(recv: typing.Callable[[int], bytes], chunks: typing.List[bytes]) -> threading.Thread:
+    thread = threading.Thread(target=_drain, args=(recv, chunks), daemon=True)
+    thread.start()
+    return thread
+
+
+def pipe_to(c: Connection, command: str, produce: typing.Callable[[ChannelWriter], None]) -> ChannelResult:
+    """
+    Выполнить команду, передав ей на stdin данные
+
+    >>> pipe_to(c, "cat > /tmp/file", lambda w: w.write(b"data"))
+
+    :param c: Конект с хостом
+    :param command: команда
+    :param produce: функция, которая пишет данные в переданный ей файлоподобный объект
+    """
+    channel = _open_channel(c, command)
+    stdout: typing.List[bytes] = []
+    stderr: typing.List[bytes] = []
+    # Drain output concurrently, otherwise remote command may block on full stdout and never read stdin
+    threads = [_start_drain(channel.recv, stdout), _start_drain(channel.recv_stderr, stderr)]
+    try:
+        produce(ChannelWriter(channel))
+        channel.shutdown_write()
+        return_code = channel.recv_exit_status()
+        for thread in threads:
+            thread.join()
+    finally:
+        channel.close()
+
+    return ChannelResult(return_code=return_code, stdout=b"".join(stdout), stderr=b"".join(stderr))
+
+
+def pipe_from(c: Connection, command: str, consume: typing.Callable[[typing.BinaryIO], None]) -> ChannelResult:
+    """
+    Выполнить команду, читая её stdout как поток
+
+    >>> pipe_from(c, "cat /tmp/file", lambda r: r.read())
+
+    :param c: Конект с хостом
+    :param command: команда
+    :param consume: функция, которая читает stdout команды из переданного ей файлоподобного объекта
+    """
+    return pipe_through(c, command, produce=lambda w: None, consume=consume)
+
+
+def pipe_through(
+    c: Connection,
+    command: str,
+    produce: typing.Callable[[ChannelWriter], None],
+    consume: typing.Callable[[typing.BinaryIO], None],
+) -> ChannelResult:
+    """
+    Выполнить команду, одновременно передавая ей данные на stdin и читая её stdout как поток
+
+    :param c: Конект с хостом
+    :param command: команда
+    :param produce: функция, которая пишет данные в переданный ей файлоподобный объект, выполняется в отдельном потоке
+    :param consume: функция, которая читает stdout команды из переданного ей файлоподобного объекта
+    """
+    channel = _open_channel(c, command)
+    stderr: typing.List[bytes] = []
+    errors: typing.List[BaseException] = []
+
+    def _produce() -> None:
+        try:
+            produce(ChannelWriter(channel))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            channel.shutdown_write()
+
+    threads = [_start_drain(channel.recv_stderr, stderr), threading.Thread(target=_produce, daemon=True)]
+    threads[1].start()
+    try:
+        reader = channel.makefile("rb")
+        consume(reader)
+        # Read the rest of the stream, so remote command is not blocked on write
+        while reader.read(BUFSIZE):
+            pass
+        return_code = channel.recv_exit_status()
+        for thread in threads:
+            thread.join()
+    finally:
+        channel.close()
+
+    if errors:
+        raise errors[0]
+    return ChannelResult(return_code=return_code, stdout=b"", stderr=b"".join(stderr))
+
+
+def check(command: str, result: ChannelResult) -> None:
+    """
+    Выбросить исключение, если команда в канале завершилась с ошибкой
+    """
+    if not result.ok:
+        stderr = result.stderr.decode(errors="replace").strip()
+        raise RuntimeError(f"{command} failed with exit code: {result.return_code}, stderr: {stderr}")
@@ -0,0 +1,207 @@
+"""
+Закачка больших файлов кусками по нескольким sftp-каналам одного ssh-соединения
+
+Файл пишется в `<путь>.carnival-part`, после закачки хеши всех кусков сверяются с локальными
+и файл переименовывается на место. Если закачка прервалась, при следующем запуске
+перекачиваются только куски, хеш которых не совпал.
+"""
+
+import hashlib
+import queue
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from carnival import Connection
+
+from carnival_contrib._digest import CHUNK_SIZE, HASHER_ALGORITHMS, HASHERS
+
+
+PART_SUFFIX = ".carnival-part"
+
+
+class Chunk(typing.NamedTuple):
+    """
+    Кусок файла
+    """
+
+    idx: int
+    offset: int
+    length: int
+
+
+class ChunkedUploadResult(typing.NamedTuple):
+    """
+    Результат закачки кусками
+    """
+
+    uploaded: int
+    """
+    Количество закачанных кусков
+    """
+    total: int
+    """
+    Количество кусков в файле
+    """
+    uploaded_bytes: int
+
+
+def split_chunks(size: int, chunk_size: int) -> typing.List[Chunk]:
+    """
+    Разбить файл на куски
+    """
+    return [
+        Chunk(idx=idx, offset=offset, length=min(chunk_size, size - offset))
+        for idx, offset in enumerate(range(0, size, chunk_size))
+    ]
+
+
+def remote_chunks_command(part_path: str, chunks: typing.Iterable[Chunk]) -> str:
+    """
+    Команда, которая выводит `hasher <hasher>`, `part <абсолютный путь>` и хеши кусков файла `<idx> <digest>`,
+    если файла нет - только первые две строки
+
+    :param part_path: путь до файла на сервере
+    :param chunks: куски, хеши которых нужно посчитать
+    """
+    hashers = " ".join(hasher for hasher, _ in HASHERS)
+    chunks_str = " ".join(f"{chunk.idx}:{chunk.offset}:{chunk.length}" for chunk in chunks)
+    return (
+        f'p="$(echo {part_path})"; '
+        f'for h in {hashers}; do if command -v $h >/dev/null; then break; fi; done; '
+        'echo hasher "$h"; echo part "$(realpath -m "$p")"; '
+        f'[ -f "$p" ] || exit 0; for x in {chunks_str}; do '
+        'i="${x%%:*}"; x="${x#*:}"; o="${x%%:*}"; l="${x#*:}"; '
+        'echo "$i" $(dd if="$p" bs=1M iflag=skip_bytes,count_bytes skip="$o" count="$l" 2>/dev/null | "$h"); '
+        'done'
+    )
+
+
+def parse_chunk_digests(stdout: str) -> typing.Tuple[str, str, typing.Dict[int, str]]:
+    """
+    Разобрать вывод :py:func:`remote_chunks_command`
+
+    :return: хешер, абсолютный путь до файла, хеши кусков
+    """
+    hasher, abspath = "", ""
+    digests: typing.Dict[int, str] = {}
+    for line in stdout.replace("\r", "").split("\n"):
+        if line.startswith("hasher "):
+            hasher = line[len("hasher "):].strip()
+        elif line.startswith("part "):
+            abspath = line[len("part "):].strip()
+        elif line.strip():
+            parts = line.split()
+            if len(parts) >= 2:
+                digests[int(parts[0])] = parts[1]
+    return hasher, abspath, digests
+
+
+def remote_chunk_digests(
+    c: Connection,
+    part_path: str,
+    chunks: typing.Iterable[Chunk],
+) -> typing.Tuple[str, str, typing.Dict[int, str]]:
+    """
+    Получить хеши кусков файла на сервере одним вызовом `c.run`
+
+    :return: алгоритм хеширования, абсолютный путь до файла, хеши кусков
+    """
+    hasher, abspath, digests = parse_chunk_digests(c.run(remote_chunks_command(part_path, chunks), hide=True).stdout)
+    if hasher not in HASHER_ALGORITHMS:
+        raise RuntimeError(f"No hash utility on host, one of: {', '.join(HASHER_ALGORITHMS)} required")
+    return HASHER_ALGORITHMS[hasher], abspath, digests
+
+
+def local_chunk_digest(path: str, chunk: Chunk, algorithm: str) -> str:
+    """
+    Хеш куска локального файла
+    """
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        f.seek(chunk.offset)
+        remaining = chunk.length
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            h.update(data)
+            remaining -= len(data)
+    return h.hexdigest()
+
+
+def _upload_worker(c: Connection, local_path: str, remote_path: str, chunks: "queue.Queue[Chunk]") -> int:
+    uploaded_bytes = 0
+    # Every sftp session is a separate channel of the same ssh connection
+    # TODO: c._c ;(
+    sftp = c._c.client.open_sftp()  # type: ignore
+    try:
+        with open(local_path, "rb") as src, sftp.open(remote_path, "r+") as dst:
+            dst.set_pipelined(True)
+            while True:
+                try:
+                    chunk = chunks.get_nowait()
+                except queue.Empty:
+                    return uploaded_bytes
+
+                src.seek(chunk.offset)
+                dst.seek(chunk.offset)
+                remaining = chunk.length
+                while remaining > 0:
+                    data = src.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise IOError(f"{local_path} changed during upload")
+                    dst.write(data)
+                    remaining -= len(data)
+                    uploaded_bytes += len(data)
+                dst.flush()
+    finally:
+        sftp.close()
+
+
+def upload_chunked(
+    c: Connection,
+    local_path: str,
+    remote_path: str,
+    size: int,
+    mode: int,
+    chunk_size: int,
+    channels: int,
+) -> ChunkedUploadResult:
+    """
+    Закачать файл кусками по нескольким sftp-каналам, с докачкой
+
+    :param c: Конект с хостом
+    :param local_path: путь до локального файла
+    :param remote_path: путь куда сохранить на сервере
+    :param size: размер локального файла
+    :param mode: права файла
+    :param chunk_size: размер куска
+    :param channels: количество параллельных sftp-каналов
+    """
+    part_path = f"{remote_path}{PART_SUFFIX}"
+    chunks = split_chunks(size, chunk_size)
+
+    # Digests of chunks which already landed in previous run
+    algorithm, abspath, remote_digests = remote_chunk_digests(c, part_path, chunks)
+    local_digests = {chunk.idx: local_chunk_digest(local_path, chunk, algorithm) for chunk in chunks}
+    missing = [chunk for chunk in chunks if remote_digests.get(chunk.idx) != local_digests[chunk.idx]]
+    c.run(f'p="$(echo {part_path})"; mkdir -p "$(dirname "$p")" && truncate -s {size} "$p"', hide=True)
+
+    chunks_queue: "queue.Queue[Chunk]" = queue.Queue()
+    for chunk in missing:
+        chunks_queue.put(chunk)
+    with ThreadPoolExecutor(max_workers=max(1, channels)) as pool:
+        futures = [
+            pool.submit(_upload_worker, c, local_path, abspath, chunks_queue)
+            for _ in range(min(channels, len(missing)))
+        ]
+        uploaded_bytes = sum(future.result() for future in futures)
+
+    # Verify uploaded chunks, chunks which matched before are not changed
+    _, _, remote_digests = remote_chunk_digests(c, part_path, missing)
+    broken = [chunk.idx for chunk in missing if remote_digests.get(chunk.idx) != local_digests[chunk.idx]]
+    if broken:
+        raise IOError(f"{remote_path} chunks digest mismatch: {broken}, run again to resume")
+
+    c.run(f'p="$(echo {remote_path})"; chmod {mode:o} "$p{PART_SUFFIX}" && mv "$p{PART_SUFFIX}" "$p"', hide=True)
+    return ChunkedUploadResult(uploaded=len(missing), total=len(chunks), uploaded_bytes=uploaded_bytes)
@@ -0,0 +1,239 @@
+"""
+Сжатие данных на лету при передаче файлов
+
+Данные сжимаются локально и разжимаются на сервере в пайпе (или наоборот), без промежуточных сжатых файлов.
+Кодеки в порядке предпочтения: zstd, lz4, gzip. zstd и lz4 используются, если установлены
+python-пакеты `zstandard` и `lz4` (`pip install carnival-contrib[compression]`), gzip доступен всегда.
+"""
+
+import importlib
+import os
+import typing
+import zlib
+
+from carnival import Connection
+
+
+def _optional_module(name: str) -> typing.Any:
+    # Imported by name, so mypy is happy both with and without optional packages installed
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+zstandard = _optional_module("zstandard")
+lz4_frame = _optional_module("lz4.frame")
+
+
+class Codec(typing.NamedTuple):
+    """
+    Кодек сжатия
+    """
+
+    name: str
+    remote_compress: str
+    """
+    Команда, которая сжимает stdin в stdout на сервере
+    """
+    remote_decompress: str
+    """
+    Команда, которая разжимает stdin в stdout на сервере
+    """
+    compressor: typing.Callable[[], typing.Any]
+    """
+    Фабрика локального компрессора с методами `compress` и `flush`
+    """
+    decompressor: typing.Callable[[], typing.Any]
+    """
+    Фабрика локального декомпрессора с методом `decompress`
+    """
+
+
+class _Lz4Compressor:
+    def __init__(self) -> None:
+        self.compressor = lz4_frame.LZ4FrameCompressor()
+        self.header: typing.Optional[bytes] = self.compressor.begin()
+
+    def compress(self, data: bytes) -> bytes:
+        header, self.header = self.header or b"", None
+        return header + bytes(self.compressor.compress(data))
+
+    def flush(self) -> bytes:
+        header, self.header = self.header or b"", None
+        return header + bytes(self.compressor.flush())
+
+
+def _codecs() -> typing.List[Codec]:
+    codecs = []
+    if zstandard is not None:
+        codecs.append(Codec(
+            name="zstd",
+            remote_compress="zstd -q -c -3",
+            remote_decompress="zstd -q -d -c",
+            compressor=lambda: zstandard.ZstdCompressor(level=3).compressobj(),
+            decompressor=lambda: zstandard.ZstdDecompressor().decompressobj(),
+        ))
+    if lz4_frame is not None:
+        codecs.append(Codec(
+            name="lz4",
+            remote_compress="lz4 -q -c",
+            remote_decompress="lz4 -q -d -c",
+            compressor=_Lz4Compressor,
+            decompressor=lambda: lz4_frame.LZ4FrameDecompressor(),
+        ))
+    codecs.append(Codec(
+        name="gzip",
+        remote_compress="gzip -c -6",
+        remote_decompress="gzip -d -c",
+        # wbits=31 - gzip container
+        compressor=lambda: zlib.compressobj(6, zlib.DEFLATED, 31),
+        decompressor=lambda: zlib.decompressobj(31),
+    ))
+    return codecs
+
+
+CODECS = _codecs()
+
+# Extensions of files which are compressed already
+COMPRESSED_EXTENSIONS = frozenset((
+    ".gz", ".tgz", ".zst", ".lz4", ".xz", ".txz", ".bz2", ".tbz2", ".lzma", ".zip", ".7z", ".rar",
+    ".jar", ".war", ".whl", ".deb", ".rpm", ".apk",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif",
+    ".mp3", ".mp4", ".mkv", ".webm", ".ogg", ".woff", ".woff2",
+))
+
+# Magic bytes of compressed formats
+COMPRESSED_MAGIC = (
+    b"\x1f\x8b",  # gzip
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"\x04\x22\x4d\x18",  # lz4
+    b"\xfd7zXZ\x00",  # xz
+    b"BZh",  # bzip2
+    b"PK\x03\x04",  # zip
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+    b"\x89PNG",
+    b"\xff\xd8\xff",  # jpeg
+)
+
+CHUNK_SIZE = 256 * 1024
+
+# Smaller files are not worth compression, codec framing overhead eats the gain
+MIN_SIZE = 4 * 1024
+
+_remote_codecs: typing.Dict[str, typing.List[str]] = {}
+
+
+def is_compressed(path: str, head: bytes = b"") -> bool:
+    """
+    Сжат ли файл уже, по расширению и по первым байтам
+
+    :param path: путь до файла
+    :param head: первые байты файла, если известны
+    """
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    return any(head.startswith(magic) for magic in COMPRESSED_MAGIC)
+
+
+def should_compress(path: str, size: typing.Optional[int], head: bytes = b"") -> bool:
+    """
+    Имеет ли смысл сжимать файл: не слишком маленький и не сжатый уже
+
+    :param path: путь до файла
+    :param size: размер файла, если известен
+    :param head: первые байты файла, если известны
+    """
+    if size is not None and size < MIN_SIZE:
+        return False
+    return not is_compressed(path, head)
+
+
+def should_compress_file(path: str) -> bool:
+    """
+    Имеет ли смысл сжимать локальный файл, см :py:func:`should_compress`
+    """
+    with open(path, "rb") as f:
+        return should_compress(path, os.fstat(f.fileno()).st_size, f.read(8))
+
+
+def get_codec(c: Connection) -> typing.Optional[Codec]:
+    """
+    Лучший кодек, доступный и локально и на сервере
+    Доступные на сервере утилиты запрашиваются один раз на хост
+
+    :return: кодек, `None` если общих кодеков нет
+    """
+    key = c.host.addr
+    if key not in _remote_codecs:
+        names = " ".join(codec.name for codec in CODECS)
+        result = c.run(f"for x in {names}; do command -v $x >/dev/null && echo $x; done; true", hide=True, warn=True)
+        _remote_codecs[key] = result.stdout.split()
+
+    for codec in CODECS:
+        if codec.name in _remote_codecs[key]:
+            return codec
+    return None
+
+
+def compress_chunks(codec: Codec, chunks: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+    """
+    Сжать поток данных
+    """
+    compressor = codec.compressor()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    data = compressor.flush()
+    if data:
+        yield data
+
+
+class CompressWriter:
+    """
+    Файлоподобный объект, который сжимает данные и пишет их в другой файлоподобный объект
+    После записи нужно вызвать `close`, он дописывает остаток сжатого потока
+    """
+
+    def __init__(self, codec: Codec, writer: typing.Any) -> None:
+        self.writer = writer
+        self.compressor = codec.compressor()
+
+    def write(self, data: bytes) -> int:
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.writer.write(compressed)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        data = self.compressor.flush()
+        if data:
+            self.writer.write(data)
+
+
+def decompress_stream(codec: Codec, reader: typing.BinaryIO, writer: typing.BinaryIO) -> int:
+    """
+    Разжать поток данных
+
+    :return: количество прочитанных сжатых байт
+    """
+    decompressor = codec.decompressor()
+    received = 0
+    for chunk in iter(lambda: reader.read(CHUNK_SIZE), b""):
+        received += len(chunk)
+        writer.write(decompressor.decompress(chunk))
+    flush = getattr(decompressor, "flush", None)
+    if flush is not None:
+        writer.write(flush())
+    return received
+
+
+def read_chunks(f: typing.BinaryIO) -> typing.Iterator[bytes]:
+    """
+    Читать файл кусками
+    """
+    return iter(lambda: f.read(CHUNK_SIZE), b"")
@@ -0,0 +1,341 @@
+"""
+Передача только изменившихся блоков файла, как в rsync
+
+Получатель считает сигнатуры блоков своей версии файла (Adler-32 и blake2b),
+отправитель ищет эти блоки в новой версии скользящим Adler-32 и отправляет только ссылки на найденные блоки
+и данные, которых у получателя нет.
+
+Модуль самодостаточный, только стандартная библиотека: на сервере он выполняется как
+`python3 -c <исходный код модуля> signature|delta|patch <путь>`, см :py:func:`remote_command`
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import typing
+import zlib
+
+
+MOD_ADLER = 65521
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+LITERAL_CHUNK_SIZE = 1024 * 1024
+STRONG_SIZE = 16
+# Rolling search is pure python, for mostly changed files it stops after this much data
+# and sends the rest as is
+GIVE_UP_SCAN_SIZE = 4 * 1024 * 1024
+GIVE_UP_LITERAL_RATIO = 0.9
+
+_MAGIC = b"CRNDLT1\n"
+_SIGNATURE_HEADER = struct.Struct(">QI")
+_SIGNATURE_BLOCK = struct.Struct(f">I{STRONG_SIZE}s")
+_DELTA_HEADER = struct.Struct(">I")
+_OP = struct.Struct(">cQ")
+
+_OP_COPY = b"C"
+_OP_LITERAL = b"L"
+_OP_END = b"E"
+
+# (block index, 0, 0) to copy receiver block or (-1, start, end) to send bytes of sender file
+DeltaOp = typing.Tuple[int, int, int]
+
+
+class Signature(typing.NamedTuple):
+    """
+    Сигнатуры блоков файла получателя
+    """
+
+    size: int
+    block_size: int
+    blocks: typing.Dict[int, typing.Dict[bytes, int]]
+    """
+    Adler-32 -> {blake2b -> индекс блока}
+    """
+    tail_size: int
+    """
+    Размер последнего неполного блока, 0 если его нет
+    """
+    tail: typing.Optional[typing.Tuple[bytes, int]]
+    """
+    blake2b и индекс последнего неполного блока
+    """
+
+    @property
+    def wire_size(self) -> int:
+        blocks_count = (self.size + self.block_size - 1) // self.block_size
+        return len(_MAGIC) + _SIGNATURE_HEADER.size + blocks_count * _SIGNATURE_BLOCK.size
+
+
+def block_size_for(size: int) -> int:
+    """
+    Размер блока, примерно корень из размера файла
+    """
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, int(size ** 0.5) // 1024 * 1024))
+
+
+def _strong(block: bytes) -> bytes:
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+def _read_exact(reader: typing.BinaryIO, size: int) -> bytes:
+    chunks = []
+    while size > 0:
+        chunk = reader.read(size)
+        if not chunk:
+            raise IOError("Unexpected end of delta stream")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def open_map(f: typing.BinaryIO) -> typing.Any:
+    if os.fstat(f.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_signature(path: str, out: typing.Any) -> int:
+    """
+    Записать сигнатуры блоков файла
+
+    :param out: файлоподобный объект с методами `write` и `flush`
+    :return: количество записанных байт
+    """
+    size = os.path.getsize(path)
+    block_size = block_size_for(size)
+    out.write(_MAGIC + _SIGNATURE_HEADER.pack(size, block_size))
+    written = len(_MAGIC) + _SIGNATURE_HEADER.size
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            out.write(_SIGNATURE_BLOCK.pack(zlib.adler32(block), _strong(block)))
+            written += _SIGNATURE_BLOCK.size
+    out.flush()
+    return written
+
+
+def read_signature(reader: typing.BinaryIO) -> typing.Optional[Signature]:
+    """
+    Прочитать сигнатуры блоков
+
+    :return: сигнатуры, `None` если поток пустой
+    """
+    magic = reader.read(len(_MAGIC))
+    if not magic:
+        return None
+    if magic != _MAGIC:
+        raise IOError("Bad signature stream")
+
+    size, block_size = _SIGNATURE_HEADER.unpack(_read_exact(reader, _SIGNATURE_HEADER.size))
+    full_blocks, tail_size = divmod(size, block_size)
+    blocks: typing.Dict[int, typing.Dict[bytes, int]] = {}
+    for idx in range(full_blocks):
+        weak, strong = _SIGNATURE_BLOCK.unpack(_read_exact(reader, _SIGNATURE_BLOCK.size))
+        blocks.setdefault(weak, {}).setdefault(strong, idx)
+
+    tail = None
+    if tail_size:
+        _, strong = _SIGNATURE_BLOCK.unpack(_read_exact(reader, _SIGNATURE_BLOCK.size))
+        tail = (strong, full_blocks)
+    return Signature(size=size, block_size=block_size, blocks=blocks, tail_size=tail_size, tail=tail)
+
+
+def compute_delta(data: typing.Any, signature: Signature) -> typing.List[DeltaOp]:
+    """
+    Найти блоки получателя в новой версии файла скользящим Adler-32
+
+    Если после :py:data:`GIVE_UP_SCAN_SIZE` байт почти все данные не нашлись у получателя,
+    поиск прекращается и остаток файла отправляется целиком
+
+    :param data: новая версия файла, `bytes` или `mmap`
+    :param signature: сигнатуры блоков получателя
+    """
+    ops: typing.List[DeltaOp] = []
+    size = len(data)
+    block_size = signature.block_size
+    blocks = signature.blocks
+    get_candidates = blocks.get
+
+    pos = 0
+    literal_start = 0
+    literal = 0
+    check_pos = GIVE_UP_SCAN_SIZE
+    last_pos = size - block_size
+    while blocks and pos <= last_pos:
+        weak = zlib.adler32(data[pos:pos + block_size])
+        a, b = weak & 0xffff, weak >> 16
+        # Single comparison per byte in the hot loop for both end of data and give up check
+        stop_pos = min(last_pos, check_pos)
+
+        while True:
+            candidates = get_candidates(weak)
+            if candidates is not None:
+                idx = candidates.get(_strong(data[pos:pos + block_size]))
+                if idx is not None:
+                    break
+            if pos >= stop_pos:
+                if pos < last_pos and literal + pos - literal_start < pos * GIVE_UP_LITERAL_RATIO:
+                    check_pos = pos + GIVE_UP_SCAN_SIZE
+                    stop_pos = min(last_pos, check_pos)
+                else:
+                    idx = None
+                    break
+            # Roll window one byte forward, this loop is the hot path for changed regions
+            out_byte = data[pos]
+            a = (a - out_byte + data[pos + block_size]) % MOD_ADLER
+            b = (b - block_size * out_byte + a - 1) % MOD_ADLER
+            weak = a | (b << 16)
+            pos += 1
+
+        if idx is None:
+            break
+        if literal_start < pos:
+            ops.append((-1, literal_start, pos))
+            literal += pos - literal_start
+        ops.append((idx, 0, 0))
+        pos += block_size
+        literal_start = pos
+        if pos > check_pos:
+            if literal >= pos * GIVE_UP_LITERAL_RATIO:
+                break
+            check_pos = pos + GIVE_UP_SCAN_SIZE
+
+    tail_start = size - signature.tail_size
+    if (
+        signature.tail is not None
+        and tail_start >= literal_start
+        and _strong(data[tail_start:size]) == signature.tail[0]
+    ):
+        if literal_start < tail_start:
+            ops.append((-1, literal_start, tail_start))
+        ops.append((signature.tail[1], 0, 0))
+    elif literal_start < size:
+        ops.append((-1, literal_start, size))
+    return ops
+
+
+def literal_size(ops: typing.Iterable[DeltaOp]) -> int:
+    """
+    Сколько байт данных нужно отправить
+    """
+    return sum(end - start for idx, start, end in ops if idx < 0)
+
+
+def write_delta(out: typing.Any, data: typing.Any, ops: typing.Iterable[DeltaOp], block_size: int) -> int:
+    """
+    Записать разницу, в конце записывается blake2b новой версии файла для проверки
+
+    :param out: файлоподобный объект с методами `write` и `flush`
+    :return: количество записанных байт
+    """
+    out.write(_MAGIC + _DELTA_HEADER.pack(block_size))
+    written = len(_MAGIC) + _DELTA_HEADER.size
+    for idx, start, end in ops:
+        if idx >= 0:
+            out.write(_OP.pack(_OP_COPY, idx))
+            written += _OP.size
+            continue
+        for chunk_start in range(start, end, LITERAL_CHUNK_SIZE):
+            chunk = data[chunk_start:min(end, chunk_start + LITERAL_CHUNK_SIZE)]
+            out.write(_OP.pack(_OP_LITERAL, len(chunk)))
+            out.write(chunk)
+            written += _OP.size + len(chunk)
+
+    out.write(_OP.pack(_OP_END, 0))
+    out.write(hashlib.blake2b(data).digest())
+    out.flush()
+    return written + _OP.size + hashlib.blake2b().digest_size
+
+
+def apply_delta(reader: typing.BinaryIO, path: str) -> typing.Optional[int]:
+    """
+    Собрать новую версию файла из старой и разницы
+    Файл пишется рядом и переименовывается на место только если совпал blake2b
+
+    :return: количество прочитанных байт разницы, `None` если поток пустой
+    """
+    magic = reader.read(len(_MAGIC))
+    if not magic:
+        return None
+    if magic != _MAGIC:
+        raise IOError("Bad delta stream")
+
+    block_size, = _DELTA_HEADER.unpack(_read_exact(reader, _DELTA_HEADER.size))
+    received = len(_MAGIC) + _DELTA_HEADER.size
+    tmp_path = f"{path}.carnival-delta"
+    h = hashlib.blake2b()
+    try:
+        with open(path, "rb") as base, open(tmp_path, "wb") as out:
+            while True:
+                op, value = _OP.unpack(_read_exact(reader, _OP.size))
+                received += _OP.size
+                if op == _OP_COPY:
+                    base.seek(value * block_size)
+                    chunk = base.read(block_size)
+                elif op == _OP_LITERAL:
+                    chunk = _read_exact(reader, value)
+                    received += value
+                elif op == _OP_END:
+                    break
+                else:
+                    raise IOError(f"Bad delta op: {op!r}")
+                h.update(chunk)
+                out.write(chunk)
+
+        digest = _read_exact(reader, h.digest_size)
+        received += h.digest_size
+        if digest != h.digest():
+            raise IOError(f"{path} digest mismatch after delta patch")
+
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return received
+
+
+def delta_for_signature(reader: typing.BinaryIO, path: str, out: typing.BinaryIO) -> int:
+    """
+    Прочитать сигнатуры получателя и записать разницу для файла
+
+    :return: количество записанных байт
+    """
+    signature = read_signature(reader)
+    if signature is None:
+        raise IOError("Empty signature stream")
+    with open(path, "rb") as f:
+        data = open_map(f)
+        return write_delta(out, data, compute_delta(data, signature), signature.block_size)
+
+
+def remote_command(mode: str, path: str) -> str:
+    """
+    Команда, которая выполняет этот модуль на сервере, код возврата 127 если на сервере нет python3
+
+    :param mode: `signature`, `delta` или `patch`
+    :param path: путь до файла на сервере
+    """
+    import inspect
+    import shlex
+
+    source = inspect.getsource(sys.modules[__name__])
+    return f'command -v python3 >/dev/null || exit 127; python3 -c {shlex.quote(source)} {mode} "$(echo {path})"'
+
+
+def main(argv: typing.List[str]) -> None:
+    mode, path = argv[1], argv[2]
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    if mode == "signature":
+        write_signature(path, stdout)
+    elif mode == "delta":
+        delta_for_signature(stdin, path, stdout)
+    elif mode == "patch":
+        apply_delta(stdin, path)
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
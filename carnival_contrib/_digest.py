@@ -0,0 +1,257 @@
+"""
+Хеши файлов для проверки, изменился ли файл
+
+На сервере хеш считается самой быстрой из доступных утилит, локально - тем же алгоритмом через `hashlib`
+"""
+
+import hashlib
+import json
+import os
+import threading
+import typing
+
+from carnival import Connection
+
+from carnival_contrib.batch import CommandBatch
+
+
+# Remote hasher command -> `hashlib` algorithm, in order of preference
+HASHERS = (
+    ("b2sum", "blake2b"),
+    ("sha1sum", "sha1"),
+    ("sha256sum", "sha256"),
+    ("shasum", "sha1"),
+)
+
+HASHER_ALGORITHMS = dict(HASHERS)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class RemoteDigest(typing.NamedTuple):
+    """
+    Размер и хеш файла на сервере
+    """
+
+    size: int
+    hasher: str
+    """
+    Утилита которой посчитан хеш, пустая строка если хеш не считался из-за несовпадения размера
+    """
+    digest: str
+    from_manifest: bool = False
+    """
+    Хеш взят из манифеста на сервере, а не посчитан заново
+    """
+
+    @property
+    def algorithm(self) -> str:
+        return HASHER_ALGORITHMS.get(self.hasher, "")
+
+
+def remote_digest_command(
+    path: str,
+    expected_size: typing.Optional[int] = None,
+    manifest: typing.Optional[str] = None,
+) -> str:
+    """
+    Команда, которая выводит `missing`, либо `<hasher> <size> <digest> [manifest]`
+
+    :param path: путь до файла
+    :param expected_size: если размер файла отличается, хеш не считается и выводится `- <size> -`
+    :param manifest: путь до манифеста хешей на сервере, см :py:func:`manifest_update_command`,
+        если размер и mtime файла совпадают с записью в манифесте, хеш берется из него
+    """
+    branches = []
+    if expected_size is not None:
+        branches.append((f'[ "$s" != "{expected_size}" ]', 'echo - "$s" -'))
+    if manifest is not None:
+        lookup = (
+            f"""awk -F'\\t' -v p="$p" -v s="$s" -v t="$(stat -c %y "$p")" """
+            """'$1 == p && $2 == s && $3 == t { r = $4 " " $2 " " $5 " manifest" } END { if (r) print r; else exit 1 }' """
+            f'"$(echo {manifest})" 2>/dev/null'
+        )
+        branches.append((f"r=$({lookup})", 'echo "$r"'))
+    for hasher, _ in HASHERS:
+        branches.append((f"command -v {hasher} >/dev/null", f'echo {hasher} "$s" $({hasher} < "$p")'))
+    hash_cmd = "; el".join([f"if {cond}; then {action}" for cond, action in branches]) + "; fi"
+
+    return (
+        f'p="$(echo {path})"; '
+        'if [ ! -f "$p" ]; then echo missing; '
+        f'else s=$(stat -c %s "$p"); {hash_cmd}; '
+        'fi'
+    )
+
+
+def manifest_update_command(manifest: str, path: str, hasher: str, digest: str) -> str:
+    """
+    Команда, которая записывает в манифест на сервере строку `<path>\\t<size>\\t<mtime>\\t<hasher>\\t<digest>`,
+    заменяя прежнюю запись для этого файла
+
+    :param manifest: путь до манифеста хешей на сервере
+    :param path: путь до файла
+    :param hasher: утилита, которой соответствует хеш, см `HASHERS`
+    :param digest: хеш текущего содержимого файла
+    """
+    return (
+        f'p="$(echo {path})"; m="$(echo {manifest})"; mkdir -p "$(dirname "$m")" && '
+        "{ "
+        f"""awk -F'\\t' -v p="$p" '$1 != p' "$m" 2>/dev/null; """
+        f"""printf '%s\\t%s\\t%s\\t%s\\t%s\\n' "$p" "$(stat -c %s "$p")" "$(stat -c %y "$p")" {hasher} {digest}; """
+        '} > "$m.tmp" && mv "$m.tmp" "$m"'
+    )
+
+
+def parse_remote_digest(stdout: str) -> typing.Optional[RemoteDigest]:
+    """
+    Разобрать вывод :py:func:`remote_digest_command`
+
+    :return: размер и хеш файла, `None` если файла нет
+    """
+    parts = stdout.strip().split()
+    if len(parts) < 3:
+        return None
+
+    hasher, size, digest = parts[:3]
+    if hasher == "-":
+        hasher, digest = "", ""
+    return RemoteDigest(size=int(size), hasher=hasher, digest=digest, from_manifest=parts[3:4] == ["manifest"])
+
+
+def remote_file_digest(
+    c: Connection,
+    fpath: str,
+    expected_size: typing.Optional[int] = None,
+    mkdir: bool = False,
+    manifest: typing.Optional[str] = None,
+) -> typing.Optional[RemoteDigest]:
+    """
+    Получить размер и хеш файла на сервере одним вызовом `c.run`
+
+    :param c: Конект с хостом
+    :param fpath: путь до файла
+    :param expected_size: не считать хеш, если размер файла отличается
+    :param mkdir: заодно создать папку файла, если её нет
+    :param manifest: путь до манифеста хешей на сервере, не используется если `None`
+    :return: размер и хеш файла, `None` если файла нет
+    """
+    batch = CommandBatch()
+    digest = batch.add(remote_digest_command(fpath, expected_size=expected_size, manifest=manifest), warn=True)
+    dirname = os.path.dirname(fpath)
+    if mkdir and dirname:
+        batch.add(f"mkdir -p {dirname}")
+
+    return parse_remote_digest(batch.run(c)[digest].stdout)
+
+
+def update_remote_manifest(
+    c: Connection,
+    manifest: str,
+    fpath: str,
+    remote: typing.Optional[RemoteDigest],
+    local_digest: typing.Callable[[str], str],
+) -> None:
+    """
+    Записать хеш файла в манифест на сервере, чтобы при следующей проверке не хешировать файл заново
+    Файл на сервере должен совпадать с локальным
+
+    :param c: Конект с хостом
+    :param manifest: путь до манифеста хешей на сервере
+    :param fpath: путь до файла на сервере
+    :param remote: размер и хеш файла на сервере, полученный до передачи файла
+    :param local_digest: функция, которая считает хеш локального файла заданным алгоритмом
+    """
+    hasher = remote.hasher if remote is not None and remote.hasher else HASHERS[0][0]
+    digest = local_digest(HASHER_ALGORITHMS[hasher])
+    c.run(manifest_update_command(manifest, fpath, hasher=hasher, digest=digest), hide=True)
+
+
+def is_same_file(
+    remote: typing.Optional[RemoteDigest],
+    local_size: int,
+    local_digest: typing.Callable[[str], str],
+) -> bool:
+    """
+    Совпадает ли файл на сервере с локальным
+
+    :param remote: размер и хеш файла на сервере
+    :param local_size: размер локального файла
+    :param local_digest: функция, которая считает хеш локального файла заданным алгоритмом
+    """
+    if remote is None or remote.size != local_size or not remote.digest:
+        return False
+    return remote.digest == local_digest(remote.algorithm)
+
+
+def bytes_digest(data: bytes, algorithm: str) -> str:
+    """
+    Хеш данных
+    """
+    return hashlib.new(algorithm, data).hexdigest()
+
+
+def local_file_digest(path: str, algorithm: str) -> str:
+    """
+    Хеш локального файла, файл читается кусками чтобы не держать его целиком в памяти
+    """
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Local digests cache, `{"<algorithm>:<abspath>": [size, mtime_ns, inode, digest]}`
+# Shared between hosts and runs, entry is valid while file size, mtime and inode are the same
+DIGEST_CACHE_PATH = os.getenv(
+    "CARNIVAL_DIGEST_CACHE",
+    os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "carnival-contrib", "digests.json"),
+)
+
+_digest_cache: typing.Optional[typing.Dict[str, typing.List[typing.Any]]] = None
+_digest_cache_lock = threading.Lock()
+
+
+def _load_digest_cache() -> typing.Dict[str, typing.List[typing.Any]]:
+    global _digest_cache
+    if _digest_cache is None:
+        try:
+            with open(DIGEST_CACHE_PATH, "r") as f:
+                _digest_cache = json.load(f)
+        except (OSError, ValueError):
+            _digest_cache = {}
+    return _digest_cache
+
+
+def _save_digest_cache(cache: typing.Dict[str, typing.List[typing.Any]]) -> None:
+    try:
+        os.makedirs(os.path.dirname(DIGEST_CACHE_PATH), exist_ok=True)
+        tmp_path = f"{DIGEST_CACHE_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, DIGEST_CACHE_PATH)
+    except OSError:
+        # Cache is optimization only, read-only home is fine
+        pass
+
+
+def cached_file_digest(path: str, algorithm: str) -> str:
+    """
+    Хеш локального файла с кешированием на диске по (путь, размер, mtime, inode)
+    """
+    st = os.stat(path)
+    key = f"{algorithm}:{os.path.abspath(path)}"
+    fingerprint = [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    with _digest_cache_lock:
+        entry = _load_digest_cache().get(key)
+    if entry is not None and entry[:3] == fingerprint:
+        return str(entry[3])
+
+    digest = local_file_digest(path, algorithm)
+    with _digest_cache_lock:
+        cache = _load_digest_cache()
+        cache[key] = [*fingerprint, digest]
+        _save_digest_cache(cache)
+    return digest
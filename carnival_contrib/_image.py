@@ -0,0 +1,142 @@
+"""
+Образы docker в tar-архивах `docker save`
+
+Из `manifest.json` архива читаются ID образа и хеши слоев, они сравниваются с образами на сервере.
+`docker load` не читает файл слоя, если цепочка слоев до него уже есть на сервере,
+поэтому такие слои можно не передавать.
+"""
+
+import hashlib
+import json
+import tarfile
+import typing
+
+from carnival import Connection
+
+
+class ImageArchive(typing.NamedTuple):
+    """
+    Образ в tar-архиве
+    """
+
+    image_id: str
+    """
+    `sha256:<хеш конфига образа>`, как `docker image inspect --format '{{.Id}}'`
+    """
+    repo_tags: typing.List[str]
+    diff_ids: typing.List[str]
+    """
+    Хеши несжатых слоев, как `docker image inspect --format '{{.RootFS.Layers}}'`
+    """
+    layers: typing.List[str]
+    """
+    Пути файлов слоев в архиве, в том же порядке что `diff_ids`
+    """
+
+
+class RemoteImage(typing.NamedTuple):
+    """
+    Образ на сервере
+    """
+
+    diff_ids: typing.List[str]
+    repo_tags: typing.List[str]
+
+
+REMOTE_IMAGES_COMMAND = (
+    "ids=$(docker image ls -aq --no-trunc 2>/dev/null | sort -u); [ -z \"$ids\" ] || "
+    "docker image inspect --format '{{.Id}} {{join .RootFS.Layers \",\"}} {{join .RepoTags \",\"}}' $ids 2>/dev/null; true"
+)
+
+
+def read_image_archive(path: str) -> typing.Optional[ImageArchive]:
+    """
+    Прочитать ID образа и слои из `manifest.json` архива
+
+    :param path: путь до tar-архива, может быть сжат
+    :return: образ, `None` если в архиве не один образ или формат не известен
+    """
+    with tarfile.open(path, "r:*") as tf:
+        try:
+            manifest = json.load(_extract(tf, "manifest.json"))
+        except (KeyError, ValueError):
+            return None
+        if not isinstance(manifest, list) or len(manifest) != 1:
+            return None
+
+        entry = manifest[0]
+        config_data = _extract(tf, entry["Config"]).read()
+
+    diff_ids = json.loads(config_data).get("rootfs", {}).get("diff_ids", [])
+    if len(diff_ids) != len(entry["Layers"]):
+        return None
+    return ImageArchive(
+        image_id=f"sha256:{hashlib.sha256(config_data).hexdigest()}",
+        repo_tags=entry.get("RepoTags") or [],
+        diff_ids=diff_ids,
+        layers=entry["Layers"],
+    )
+
+
+def _extract(tf: tarfile.TarFile, name: str) -> typing.IO[bytes]:
+    f = tf.extractfile(name)
+    if f is None:
+        raise KeyError(name)
+    return f
+
+
+def parse_remote_images(stdout: str) -> typing.Dict[str, RemoteImage]:
+    """
+    Разобрать вывод :py:data:`REMOTE_IMAGES_COMMAND`
+    """
+    images = {}
+    for line in stdout.replace("\r", "").split("\n"):
+        parts = line.split(" ")
+        if len(parts) != 3 or not parts[0].startswith("sha256:"):
+            continue
+        image_id, layers, tags = parts
+        images[image_id] = RemoteImage(
+            diff_ids=[x for x in layers.split(",") if x],
+            repo_tags=[x for x in tags.split(",") if x],
+        )
+    return images
+
+
+def remote_images(c: Connection) -> typing.Dict[str, RemoteImage]:
+    """
+    Все образы на сервере с их слоями и тегами, одним вызовом `c.run`
+
+    :return: ID образа -> образ
+    """
+    return parse_remote_images(c.run(REMOTE_IMAGES_COMMAND, hide=True, warn=True).stdout)
+
+
+def present_layers(image: ImageArchive, images: typing.Iterable[RemoteImage]) -> int:
+    """
+    Сколько первых слоев образа уже есть на сервере, самый длинный общий префикс с образами сервера
+    """
+    best = 0
+    for remote in images:
+        n = 0
+        for local_id, remote_id in zip(image.diff_ids, remote.diff_ids):
+            if local_id != remote_id:
+                break
+            n += 1
+        best = max(best, n)
+    return best
+
+
+def write_reduced_archive(path: str, fileobj: typing.Any, skip: typing.Iterable[str]) -> None:
+    """
+    Переписать архив потоком без файлов слоев
+
+    :param path: путь до tar-архива, может быть сжат
+    :param fileobj: файлоподобный объект с методом `write`
+    :param skip: пути файлов слоев в архиве
+    """
+    skip = set(skip)
+    with tarfile.open(path, "r|*") as src, tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as dst:
+        for member in src:
+            if member.name in skip:
+                continue
+            dst.addfile(member, src.extractfile(member) if member.isfile() else None)
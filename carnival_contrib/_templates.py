@@ -0,0 +1,124 @@
+"""
+Кеш отрендеренных jinja2-шаблонов
+
+Шаблон с одинаковым контекстом рендерится один раз за запуск, на всех хостах и при валидации,
+вместе с результатом запоминаются его хеши.
+"""
+
+import hashlib
+import json
+import threading
+import typing
+from collections import OrderedDict
+
+from jinja2.exceptions import TemplateNotFound, TemplateSyntaxError, UndefinedError
+
+from carnival import Connection
+from carnival.templates import j2_env, render
+from carnival.steps import validators
+
+
+CACHE_SIZE = 1024
+
+
+class RenderedTemplate:
+    """
+    Отрендеренный шаблон
+    """
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self._digests: typing.Dict[str, str] = {}
+
+    def digest(self, algorithm: str) -> str:
+        """
+        Хеш отрендеренного шаблона, считается один раз на алгоритм
+        """
+        if algorithm not in self._digests:
+            self._digests[algorithm] = hashlib.new(algorithm, self.data).hexdigest()
+        return self._digests[algorithm]
+
+
+# (template path, context fingerprint) -> (compiled template, rendered template)
+_render_cache: "OrderedDict[typing.Tuple[str, str], typing.Tuple[typing.Any, RenderedTemplate]]" = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+
+def _is_json_native(value: typing.Any) -> bool:
+    """
+    Значение однозначно сериализуется в JSON: JSON отличает не все типы python (например tuple и list),
+    а repr пользовательских объектов может не отражать их состояние
+    """
+    value_type = type(value)
+    if value_type in (str, int, float, bool) or value is None:
+        return True
+    if value_type is list:
+        return all(_is_json_native(x) for x in value)
+    if value_type is dict:
+        return all(type(k) is str and _is_json_native(v) for k, v in value.items())
+    return False
+
+
+def context_fingerprint(context: typing.Dict[str, typing.Any]) -> typing.Optional[str]:
+    """
+    Отпечаток контекста шаблона
+
+    :return: отпечаток, `None` если в контексте есть значения кроме dict, list, str, int, float, bool и None,
+        такой шаблон не кешируется
+    """
+    if not _is_json_native(context):
+        return None
+    data = json.dumps(context, sort_keys=True)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def render_cached(template_path: str, context: typing.Dict[str, typing.Any]) -> RenderedTemplate:
+    """
+    Отрендерить шаблон, результат кешируется по (шаблон, отпечаток контекста)
+    Если файл шаблона изменился, jinja2 перекомпилирует его и кеш для него не используется
+
+    :param template_path: путь до шаблона
+    :param context: контекст шаблона
+    """
+    fingerprint = context_fingerprint(context)
+    if fingerprint is None:
+        return RenderedTemplate(render(template_path, **context).encode())
+
+    # jinja2 keeps compiled template while it is up to date
+    template = j2_env.get_template(template_path)
+    key = (template_path, fingerprint)
+    with _render_cache_lock:
+        entry = _render_cache.get(key)
+        if entry is not None and entry[0] is template:
+            _render_cache.move_to_end(key)
+            return entry[1]
+
+    rendered = RenderedTemplate(render(template_path, **context).encode())
+    with _render_cache_lock:
+        _render_cache[key] = (template, rendered)
+        _render_cache.move_to_end(key)
+        while len(_render_cache) > CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    return rendered
+
+
+class CachedTemplateValidator(validators.StepValidatorBase):
+    """
+    Валидатор шаблонов, как `validators.TemplateValidator`, но результат рендеринга кешируется
+    и используется повторно при выполнении шага
+    """
+
+    def __init__(self, template_path: str, context: typing.Dict[str, typing.Any]):
+        """
+        :param template_path: путь до шаблона
+        :param context: контекст шаблона
+        """
+        self.template_path = template_path
+        self.context = context
+
+    def validate(self, c: Connection) -> typing.Optional[str]:
+        try:
+            render_cached(self.template_path, self.context)
+        except (UndefinedError, TemplateNotFound, TemplateSyntaxError) as ex:
+            return f"{ex.__class__.__name__}: {ex}"
+        return None
@@ -0,0 +1,313 @@
+"""
+Синхронизация дерева файлов: листинг на сервере одной командой, сравнение с локальным деревом
+и передача измененных файлов одним tar-потоком
+"""
+
+import io
+import os
+import shlex
+import shutil
+import tarfile
+import time
+import typing
+
+from colorama import Style as S, Fore as F  # type: ignore
+
+from carnival import Connection
+
+from carnival_contrib._digest import HASHER_ALGORITHMS, HASHERS
+
+
+# Prefix of remote staging dir, created inside destination dir so `mv` into place is atomic rename
+STAGING_PREFIX = ".carnival-sync."
+
+
+class TreeEntry(typing.NamedTuple):
+    """
+    Файл в дереве
+    """
+
+    size: int
+    mtime: float
+    digest: str
+    """
+    Хеш файла, пустая строка если хеш не известен
+    """
+
+
+class RemoteTree(typing.NamedTuple):
+    """
+    Дерево файлов на сервере
+    """
+
+    hasher: str
+    entries: typing.Dict[str, TreeEntry]
+    """
+    Относительный путь -> файл
+    """
+
+    @property
+    def algorithm(self) -> str:
+        return HASHER_ALGORITHMS.get(self.hasher, "")
+
+
+class TreeChanges(typing.NamedTuple):
+    """
+    Изменения дерева файлов, относительные пути
+    """
+
+    added: typing.List[str]
+    changed: typing.List[str]
+    deleted: typing.List[str]
+
+    @property
+    def transferred(self) -> typing.List[str]:
+        return self.added + self.changed
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.added or self.changed or self.deleted)
+
+
+def print_tree_changes(path: str, changes: TreeChanges) -> None:
+    """
+    Вывести изменения дерева файлов
+    """
+    if not changes.has_changes:
+        print(f"{S.BRIGHT}{path}{S.RESET_ALL}: {F.GREEN}not changed{F.RESET}")
+        return
+
+    for relpath in changes.added:
+        print(f"{S.BRIGHT}{path}/{relpath}{S.RESET_ALL}: {F.YELLOW}added{F.RESET}")
+    for relpath in changes.changed:
+        print(f"{S.BRIGHT}{path}/{relpath}{S.RESET_ALL}: {F.YELLOW}changed{F.RESET}")
+    for relpath in changes.deleted:
+        print(f"{S.BRIGHT}{path}/{relpath}{S.RESET_ALL}: {F.RED}deleted{F.RESET}")
+
+
+def remote_tree_command(path: str, relpaths: typing.Optional[typing.Iterable[str]] = None) -> str:
+    """
+    Команда, которая выводит хешер `hasher <hasher>`, строки `file\\t<size>\\t<mtime>\\t<path>`
+    и хеши всех файлов в формате `<hasher>`. Для несуществующей папки ничего не выводит,
+    если на сервере нет ни одной утилиты хеширования - завершается с ошибкой
+
+    :param path: путь до папки
+    :param relpaths: только эти файлы, а не все файлы папки
+    """
+    hashers = " ".join(hasher for hasher, _ in HASHERS)
+    command = (
+        f'd="$(echo {path})"; [ -d "$d" ] || exit 0; cd "$d" || exit 1; '
+        f'for h in {hashers}; do if command -v $h >/dev/null; then break; fi; done; '
+        f'command -v "$h" >/dev/null || {{ echo "No hash utility on host, one of: {hashers} required" >&2; exit 1; }}; '
+        'echo hasher "$h"; '
+    )
+    if relpaths is None:
+        find = f"find . -path './{STAGING_PREFIX}*' -prune -o -type f"
+        return (
+            f"{command}"
+            f"{find} -printf 'file\\t%s\\t%T@\\t%P\\n' && "
+            f'{find} -exec "$h" {{}} +'
+        )
+
+    quoted = " ".join(shlex.quote(f"./{x}") for x in relpaths)
+    return (
+        f'{command}set --; for f in {quoted}; do if [ -f "$f" ]; then set -- "$@" "$f"; fi; done; '
+        '[ $# -eq 0 ] || { '
+        "stat --printf 'file\\t%s\\t%Y\\t%n\\n' -- \"$@\" && \"$h\" -- \"$@\"; "
+        '}'
+    )
+
+
+def parse_remote_tree(stdout: str) -> RemoteTree:
+    """
+    Разобрать вывод :py:func:`remote_tree_command`
+    """
+    hasher = ""
+    entries: typing.Dict[str, TreeEntry] = {}
+    digests: typing.Dict[str, str] = {}
+    for line in stdout.replace("\r", "").split("\n"):
+        if not line:
+            continue
+        if line.startswith("hasher "):
+            hasher = line[len("hasher "):].strip()
+        elif line.startswith("file\t"):
+            _, size, mtime, relpath = line.split("\t", 3)
+            if relpath.startswith("./"):
+                relpath = relpath[2:]
+            entries[relpath] = TreeEntry(size=int(size), mtime=float(mtime), digest="")
+        elif "  ./" in line and not line.startswith("\\"):
+            # Names with special chars are escaped by hasher and start with `\`, these are left without digest
+            digest, relpath = line.split("  ./", 1)
+            digests[relpath] = digest
+
+    return RemoteTree(
+        hasher=hasher,
+        entries={relpath: entry._replace(digest=digests.get(relpath, "")) for relpath, entry in entries.items()},
+    )
+
+
+def remote_tree(c: Connection, path: str, relpaths: typing.Optional[typing.Iterable[str]] = None) -> RemoteTree:
+    """
+    Получить размеры, mtime и хеши всех файлов папки на сервере одним вызовом `c.run`
+
+    :param c: Конект с хостом
+    :param path: путь до папки
+    :param relpaths: только эти файлы, а не все файлы папки
+    """
+    return parse_remote_tree(c.run(remote_tree_command(path, relpaths), hide=True).stdout)
+
+
+def local_tree(path: str) -> typing.Dict[str, TreeEntry]:
+    """
+    Размеры и mtime всех файлов локальной папки, хеши не считаются
+
+    :param path: путь до папки
+    """
+    entries: typing.Dict[str, TreeEntry] = {}
+    if not os.path.isdir(path):
+        return entries
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [x for x in dirnames if not x.startswith(STAGING_PREFIX)]
+        for filename in filenames:
+            fpath = os.path.join(dirpath, filename)
+            if not os.path.isfile(fpath):
+                continue
+            st = os.stat(fpath)
+            relpath = os.path.relpath(fpath, path).replace(os.sep, "/")
+            entries[relpath] = TreeEntry(size=st.st_size, mtime=st.st_mtime, digest="")
+    return entries
+
+
+def diff_trees(
+    src: typing.Dict[str, TreeEntry],
+    dst: typing.Dict[str, TreeEntry],
+    is_same: typing.Callable[[str], bool],
+    delete: bool = False,
+) -> TreeChanges:
+    """
+    Сравнить деревья файлов
+
+    :param src: дерево источника
+    :param dst: дерево назначения
+    :param is_same: функция, которая сравнивает содержимое файла одинакового размера по относительному пути
+    :param delete: считать удаленными файлы, которых нет в источнике
+    """
+    added, changed = [], []
+    for relpath in sorted(src):
+        dst_entry = dst.get(relpath)
+        if dst_entry is None:
+            added.append(relpath)
+        elif dst_entry.size != src[relpath].size or not is_same(relpath):
+            changed.append(relpath)
+
+    deleted = sorted(set(dst) - set(src)) if delete else []
+    return TreeChanges(added=added, changed=changed, deleted=deleted)
+
+
+def write_tar(fileobj: typing.Any, root: str, relpaths: typing.Iterable[str]) -> None:
+    """
+    Записать файлы потоком tar, без seek и без временных файлов
+
+    :param fileobj: файлоподобный объект с методом `write`
+    :param root: локальная папка
+    :param relpaths: относительные пути файлов
+    """
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT, dereference=True) as tf:
+        for relpath in relpaths:
+            tf.add(os.path.join(root, relpath), arcname=relpath, recursive=False)
+
+
+def write_tar_bytes(fileobj: typing.Any, files: typing.Dict[str, bytes], mode: int = 0o644) -> None:
+    """
+    Записать содержимое файлов из памяти потоком tar
+
+    :param fileobj: файлоподобный объект с методом `write`
+    :param files: относительный путь -> содержимое файла
+    :param mode: права новых файлов, чтобы сохранить права существующих файлов см `keep_modes` в :py:func:`remote_untar_command`
+    """
+    mtime = int(time.time())
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as tf:
+        for relpath, data in files.items():
+            info = tarfile.TarInfo(relpath)
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = mtime
+            tf.addfile(info, io.BytesIO(data))
+
+
+def read_tar(fileobj: typing.Any, root: str, relpaths: typing.Iterable[str]) -> typing.List[str]:
+    """
+    Распаковать поток tar в локальную папку
+    Каждый файл пишется во временный файл рядом и переименовывается на место
+
+    :param fileobj: файлоподобный объект с методом `read`
+    :param root: локальная папка
+    :param relpaths: относительные пути файлов, которые ожидаются в потоке, остальные файлы игнорируются
+    :return: распакованные файлы
+    """
+    expected = set(relpaths)
+    extracted = []
+    with tarfile.open(fileobj=fileobj, mode="r|") as tf:
+        for member in tf:
+            if not member.isfile() or member.name not in expected:
+                continue
+
+            fpath = os.path.join(root, *member.name.split("/"))
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            tmp_path = f"{fpath}.carnival-tmp"
+            reader = tf.extractfile(member)
+            assert reader is not None
+            with reader, open(tmp_path, "wb") as writer:
+                shutil.copyfileobj(reader, writer, 1024 * 1024)
+            os.chmod(tmp_path, member.mode)
+            os.utime(tmp_path, (member.mtime, member.mtime))
+            os.replace(tmp_path, fpath)
+            extracted.append(member.name)
+    return extracted
+
+
+def remote_untar_command(path: str, deleted: typing.Iterable[str] = (), keep_modes: bool = False) -> str:
+    """
+    Команда, которая распаковывает поток tar со stdin во временную папку и переносит файлы на место
+
+    :param path: путь до папки на сервере
+    :param deleted: относительные пути файлов, которые нужно удалить после распаковки
+    :param keep_modes: оставить права уже существующих файлов вместо прав из архива
+    """
+    keep = '{ [ ! -f "$0/$f" ] || chmod "$(stat -c %a "$0/$f")" "$f"; } && ' if keep_modes else ""
+    move = f'for f; do mkdir -p "$0/$(dirname "$f")" && {keep}mv -f "$f" "$0/$f" || exit 1; done'
+    command = (
+        f'd="$(echo {path})"; t="$d/{STAGING_PREFIX}$$"; '
+        'mkdir -p "$t" && tar -x -C "$t" -f - && '
+        f"""(cd "$t" && find . -type f -exec sh -c '{move}' "$d" {{}} +); """
+        'rc=$?; rm -rf "$t"; [ $rc -eq 0 ] || exit $rc'
+    )
+    deleted_cmd = remote_delete_command(path, deleted)
+    if deleted_cmd:
+        command = f"{command}; {deleted_cmd}"
+    return command
+
+
+def remote_delete_command(path: str, deleted: typing.Iterable[str]) -> str:
+    """
+    Команда, которая удаляет файлы из папки на сервере, пустая строка если удалять нечего
+
+    :param path: путь до папки на сервере
+    :param deleted: относительные пути файлов
+    """
+    quoted = " ".join(shlex.quote(x) for x in deleted)
+    if not quoted:
+        return ""
+    return f'cd "$(echo {path})" && rm -f -- {quoted}'
+
+
+def remote_tar_command(path: str, relpaths: typing.Iterable[str]) -> str:
+    """
+    Команда, которая пишет файлы папки на сервере потоком tar в stdout
+
+    :param path: путь до папки на сервере
+    :param relpaths: относительные пути файлов
+    """
+    quoted = " ".join(shlex.quote(x) for x in relpaths)
+    return f'cd "$(echo {path})" && tar -c -f - -- {quoted}'
@@ -1,35 +1,265 @@
+import fnmatch
+import functools
+import os.path
+import time
 import typing
+import urllib.parse
 
 from colorama import Style as S, Fore as F  # type: ignore
 
+from fabric.transfer import Transfer  # type: ignore
+
 from carnival import Step
 from carnival import Connection
-from carnival.steps import validators
+from carnival.steps import shortcuts, validators
+
+from carnival_contrib.batch import CommandBatch, CommandResult
+
+
+def _order(ch: str) -> int:
+    # Same as `order()` from dpkg lib/dpkg/version.c
+    if ch.isdigit():
+        return 0
+    if ch.isascii() and ch.isalpha():
+        return ord(ch)
+    if ch == "~":
+        return -1
+    return ord(ch) + 256
+
+
+def _verrevcmp(a: str, b: str) -> int:
+    # Same as `verrevcmp()` from dpkg lib/dpkg/version.c
+    i, j = 0, 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i]) if i < len(a) else 0
+            bc = _order(b[j]) if j < len(b) else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+
+        while i < len(a) and a[i] == "0":
+            i += 1
+        while j < len(b) and b[j] == "0":
+            j += 1
+
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def _parse_version(version: str) -> typing.Tuple[int, str, str]:
+    """
+    Разобрать версию пакета `[epoch:]upstream_version[-debian_revision]`
+    """
+    epoch, sep, rest = version.partition(":")
+    if not sep:
+        epoch, rest = "0", version
+    upstream, sep, revision = rest.rpartition("-")
+    if not sep:
+        upstream, revision = rest, ""
+    return int(epoch) if epoch.isdigit() else 0, upstream, revision
+
+
+def compare_versions(a: str, b: str) -> int:
+    """
+    Сравнить версии пакетов по правилам Debian (как `dpkg --compare-versions`)
+
+    :return: отрицательное число если `a` < `b`, `0` если версии равны, положительное если `a` > `b`
+    """
+    a_epoch, a_upstream, a_revision = _parse_version(a)
+    b_epoch, b_upstream, b_revision = _parse_version(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+    return _verrevcmp(a_upstream, b_upstream) or _verrevcmp(a_revision, b_revision)
+
+
+_CONSTRAINT_OPERATORS: typing.Dict[str, typing.Callable[[int], bool]] = {
+    ">=": lambda x: x >= 0,
+    "<=": lambda x: x <= 0,
+    ">>": lambda x: x > 0,
+    "<<": lambda x: x < 0,
+    ">": lambda x: x > 0,
+    "<": lambda x: x < 0,
+    "=": lambda x: x == 0,
+}
+
+
+def _match_clause(version: str, clause: str) -> bool:
+    for op, check in _CONSTRAINT_OPERATORS.items():
+        if clause.startswith(op):
+            return check(compare_versions(version, clause[len(op):].strip()))
+
+    # Glob, matched against full version and version without epoch
+    _, sep, epochless = version.partition(":")
+    return fnmatch.fnmatchcase(version, clause) or (bool(sep) and fnmatch.fnmatchcase(epochless, clause))
+
+
+def match_version(versions: typing.List[str], constraint: str) -> typing.Optional[str]:
+    """
+    Найти самую новую версию, подходящую под ограничение
+
+    >>> versions = ["5:24.0.7-1~ubuntu.22.04~jammy", "5:23.0.6-1~ubuntu.22.04~jammy", "5:20.10.24~3-0~ubuntu-jammy"]
+    >>> match_version(versions, "24.*")
+    '5:24.0.7-1~ubuntu.22.04~jammy'
+    >>> match_version(versions, ">=5:23, <<5:24")
+    '5:23.0.6-1~ubuntu.22.04~jammy'
+    >>> match_version(versions, "<<5:20") is None
+    True
+
+    :param versions: список версий
+    :param constraint: ограничения через запятую, каждое - glob-шаблон (`24.*`)
+        или сравнение с версией (`>=`, `<=`, `>>`, `<<`, `>`, `<`, `=`)
+    :return: самая новая подходящая версия, `None` если таких нет
+    """
+    clauses = [x.strip() for x in constraint.split(",") if x.strip()]
+    matched = [x for x in versions if all(_match_clause(x, clause) for clause in clauses)]
+    if not matched:
+        return None
+    return max(matched, key=functools.cmp_to_key(compare_versions))
+
+
+class GetPackagesVersions(Step):
+    """
+    Получить доступные версии нескольких пакетов одним вызовом `apt-cache madison`
+
+    :return: Словарь `{пакет: [версии]}`, версии отсортированы от новой к старой
+    """
+
+    def __init__(self, pkg_names: typing.List[str]):
+        """
+        :param pkg_names: список пакетов
+        """
+        self.pkg_names = pkg_names
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return [
+            validators.CommandRequiredValidator('apt-cache'),
+        ]
+
+    def run(self, c: Connection) -> typing.Dict[str, typing.List[str]]:
+        """
+        :return: Словарь `{пакет: [версии]}`, версии отсортированы от новой к старой
+        """
+        versions: typing.Dict[str, typing.List[str]] = {x: [] for x in self.pkg_names}
+        if not self.pkg_names:
+            return versions
+
+        # madison exits with non-zero code if any of packages is unknown, but still prints the rest
+        result = c.run(
+            f"DEBIAN_FRONTEND=noninteractive apt-cache madison {' '.join(self.pkg_names)}",
+            hide=True, warn=True,
+        )
+        for line in result.stdout.strip().split("\n"):
+            # `docker-ce | 5:24.0.7-1~ubuntu.22.04~jammy | https://download.docker.com/linux/ubuntu jammy/stable amd64 Packages`
+            parts = [x.strip() for x in line.split("|")]
+            if len(parts) < 2:
+                continue
+
+            pkgn, ver = parts[0], parts[1]
+            if pkgn in versions and ver and ver not in versions[pkgn]:
+                versions[pkgn].append(ver)
+
+        for pkgn in versions:
+            versions[pkgn].sort(key=functools.cmp_to_key(compare_versions), reverse=True)
+        return versions
 
 
 class GetPackageVersions(Step):
     """
-    Получить список доступных версий пакета
+    Получить список доступных версий пакета, от новой к старой
     """
 
     def __init__(self, pkgname: str):
         self.pkgname = pkgname
+        self.get_packages_versions = GetPackagesVersions(pkg_names=[self.pkgname])
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return self.get_packages_versions.get_validators()
+
+    def run(self, c: Connection) -> typing.List[str]:
+        return self.get_packages_versions.run(c=c)[self.pkgname]
+
+
+# Installed packages versions, `{host.addr: {pkgname: version}}`, version is `None` if package is not installed
+# Filled by `GetInstalledPackagesVersions`, invalidated by steps which install or remove packages
+_installed_versions: typing.Dict[str, typing.Dict[str, typing.Optional[str]]] = {}
+
+
+def _invalidate_installed_versions(c: Connection) -> None:
+    """
+    Сбросить закешированное состояние пакетов хоста после установки или удаления
+
+    `apt-get install` может обновить зависимости и удалить конфликтующие пакеты,
+    поэтому сбрасывается состояние всех пакетов, а не только установленных
+    """
+    _installed_versions.pop(c.host.addr, None)
+
+
+def _dpkg_query_command(pkg_names: typing.List[str]) -> str:
+    # dpkg-query exits with non-zero code if any of packages is unknown, but still prints the rest
+    return r"DEBIAN_FRONTEND=noninteractive dpkg-query -W -f='${Package}\t${Status}\t${Version}\n' " + " ".join(pkg_names)
+
+
+def _store_installed_versions(c: Connection, pkg_names: typing.List[str], dpkg_query_stdout: str) -> None:
+    """
+    Разобрать вывод `dpkg-query` и сохранить состояние пакетов в кеш
+    """
+    versions: typing.Dict[str, typing.Optional[str]] = {x: None for x in pkg_names}
+    for line in dpkg_query_stdout.strip().split("\n"):
+        parts = line.split("\t")
+        if len(parts) != 3:
+            continue
+
+        pkgn, status, ver = parts
+        # Status is `want flag status`, eg `install ok installed` or `deinstall ok config-files`
+        if pkgn in versions and status.split()[-1:] == ["installed"]:
+            versions[pkgn] = ver.strip()
+
+    _installed_versions.setdefault(c.host.addr, {}).update(versions)
+
+
+class GetInstalledPackagesVersions(Step):
+    """
+    Получить установленные версии нескольких пакетов одним вызовом `dpkg-query`
+
+    :return: Словарь `{пакет: версия}`, версия `None` если пакет не установлен
+    """
+
+    def __init__(self, pkg_names: typing.List[str]):
+        """
+        :param pkg_names: список пакетов
+        """
+        self.pkg_names = pkg_names
 
     def get_validators(self) -> typing.List[validators.StepValidatorBase]:
         return [
-            validators.CommandRequiredValidator('apt-cache'),
+            validators.CommandRequiredValidator('dpkg-query'),
         ]
 
-    def run(self, c: Connection) -> typing.List[str]:
-        versions = []
-        result = c.run(f"DEBIAN_FRONTEND=noninteractive apt-cache madison {self.pkgname}", hide=True, warn=True)
-        if result.ok is False:
-            return []
+    def run(self, c: Connection) -> typing.Dict[str, typing.Optional[str]]:
+        """
+        :return: Словарь `{пакет: версия}`, версия `None` если пакет не установлен
+        """
+        cached = _installed_versions.setdefault(c.host.addr, {})
+        unknown = [x for x in self.pkg_names if x not in cached]
+        if unknown:
+            result = c.run(_dpkg_query_command(unknown), hide=True, warn=True)
+            _store_installed_versions(c, unknown, result.stdout)
 
-        for line in result.stdout.strip().split("\n"):
-            n, ver, r = line.split("|")
-            versions.append(ver.strip())
-        return versions
+        return {x: cached[x] for x in self.pkg_names}
 
 
 class GetInstalledPackageVersion(Step):
@@ -41,26 +271,26 @@ class GetInstalledPackageVersion(Step):
 
     def __init__(self, pkgname: str):
         self.pkgname = pkgname
+        self.get_installed_packages_versions = GetInstalledPackagesVersions(pkg_names=[self.pkgname])
 
     def get_validators(self) -> typing.List[validators.StepValidatorBase]:
-        return [
-            validators.CommandRequiredValidator('dpkg'),
-        ]
+        return self.get_installed_packages_versions.get_validators()
 
     def run(self, c: Connection) -> typing.Optional[str]:
         """
         :return: Версия пакета если установлен, `None` если пакет не установлен
         """
-        result = c.run(f"DEBIAN_FRONTEND=noninteractive dpkg -l {self.pkgname} | grep '{self.pkgname}'", hide=True, warn=True)
-        if result.ok is False:
-            return None
+        return self.get_installed_packages_versions.run(c=c)[self.pkgname]
 
-        installed, pkgn, ver, arch, *desc = result.stdout.strip().split("\n")[0].split()
-        if installed != 'ii':
-            return None
 
-        assert isinstance(ver, str)
-        return ver.strip()
+def _is_installed(pkgver: typing.Optional[str], version: typing.Optional[str]) -> bool:
+    """
+    Проверить по установленной версии `pkgver` удовлетворяет ли пакет версии `version`
+    Если версия не указана - подходит любая
+    """
+    if pkgver is None:
+        return False
+    return version is None or pkgver == version
 
 
 class IsPackageInstalled(Step):
@@ -83,14 +313,124 @@ class IsPackageInstalled(Step):
         Если версия не указана - проверяется любая
         """
 
-        pkgver = self.get_installed_package_version.run(c=c)
-        if self.version is None and pkgver is not None:
-            return True
+        return _is_installed(self.get_installed_package_version.run(c=c), self.version)
 
-        if self.version is not None and pkgver == self.version:
-            return True
 
-        return False
+# Last `apt-get update` time by local clock, `{host.addr: timestamp}`
+# Remote is probed once per run, later steps check freshness without round trips
+_updated_at: typing.Dict[str, float] = {}
+
+_UPDATE_STAMP = "/var/lib/apt/periodic/carnival-update-stamp"
+
+
+# stat exits with non-zero code if any of files is missing, but still prints the rest.
+# Stamps say nothing if package lists were wiped after update (`rm -rf /var/lib/apt/lists/*` in images),
+# so they are used only if lists are in place
+_UPDATED_AT_COMMAND = (
+    "date +%s; ls /var/lib/apt/lists/*_Packages >/dev/null 2>&1 && "
+    f"stat -c %Y {_UPDATE_STAMP} /var/lib/apt/periodic/update-success-stamp 2>/dev/null"
+)
+
+
+def _store_updated_at(c: Connection, updated_at_stdout: str) -> None:
+    """
+    Разобрать вывод `_UPDATED_AT_COMMAND` и сохранить время последнего обновления списков пакетов в кеш
+    """
+    timestamps = [int(x) for x in updated_at_stdout.split() if x.isdigit()]
+    if len(timestamps) < 2:
+        return
+
+    remote_now, *mtimes = timestamps
+    _updated_at[c.host.addr] = time.time() - (remote_now - max(mtimes))
+
+
+def _get_updated_at(c: Connection) -> typing.Optional[float]:
+    """
+    Узнать когда на хосте последний раз обновлялись списки пакетов
+
+    :return: время по часам локальной машины, `None` если неизвестно
+    """
+    if c.host.addr not in _updated_at:
+        _store_updated_at(c, c.run(_UPDATED_AT_COMMAND, hide=True, warn=True).stdout)
+    return _updated_at.get(c.host.addr)
+
+
+def prefetch_state(
+    c: Connection,
+    pkg_names: typing.List[str],
+    updated_at: bool,
+    extra_commands: typing.Sequence[str] = (),
+) -> typing.List[CommandResult]:
+    """
+    Заполнить кеши состояния пакетов и свежести списков пакетов одним вызовом,
+    шаги этого модуля, запущенные после, берут состояние из кешей без отдельных вызовов `c.run`
+
+    >>> repo, = prefetch_state(c, ["docker-ce", "curl"], updated_at=True, extra_commands=["ls /etc/apt/sources.list.d"])
+
+    :param pkg_names: пакеты, состояние которых понадобится
+    :param updated_at: понадобится ли время последнего обновления списков пакетов
+    :param extra_commands: дополнительные проверки, которые выполняются тем же вызовом с `warn=True`
+    :return: результаты дополнительных проверок
+    """
+    unknown = [x for x in pkg_names if x not in _installed_versions.get(c.host.addr, {})]
+    need_updated_at = updated_at and c.host.addr not in _updated_at
+
+    batch = CommandBatch()
+    dpkg_query_idx = batch.add(_dpkg_query_command(unknown), warn=True) if unknown else None
+    updated_at_idx = batch.add(_UPDATED_AT_COMMAND, warn=True) if need_updated_at else None
+    extra_idxs = [batch.add(command, warn=True) for command in extra_commands]
+
+    results = batch.run(c)
+    if dpkg_query_idx is not None:
+        _store_installed_versions(c, unknown, results[dpkg_query_idx].stdout)
+    if updated_at_idx is not None:
+        _store_updated_at(c, results[updated_at_idx].stdout)
+    return [results[idx] for idx in extra_idxs]
+
+
+class Update(Step):
+    """
+    Обновить списки пакетов `apt-get update`, если они не обновлялись дольше `ttl` секунд
+    """
+
+    def __init__(self, ttl: int = 3600, hide: bool = False) -> None:
+        """
+        :param ttl: сколько секунд списки пакетов считаются свежими, `0` - обновлять всегда
+        :param hide: скрыть вывод этапов
+        """
+        self.ttl = ttl
+        self.hide = hide
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return [
+            validators.CommandRequiredValidator('apt-get'),
+        ]
+
+    def run(self, c: Connection) -> bool:
+        """
+        :return: `True` если списки пакетов были обновлены, `False` если они еще свежие
+        """
+        if self.ttl > 0:
+            updated_at = _get_updated_at(c)
+            if updated_at is not None and time.time() - updated_at < self.ttl:
+                return False
+
+        c.run(
+            "DEBIAN_FRONTEND=noninteractive sudo apt-get update && "
+            f"sudo mkdir -p {os.path.dirname(_UPDATE_STAMP)} && sudo touch {_UPDATE_STAMP}",
+            hide=self.hide,
+        )
+        _updated_at[c.host.addr] = time.time()
+        return True
+
+
+def pkg_spec(pkgname: str, version: typing.Optional[str]) -> str:
+    """
+    Строка пакета для `apt-get install`: `name` или `name=version`
+    """
+    if version:
+        return f"{pkgname}={version}"
+    return pkgname
 
 
 class ForceInstall(Step):
@@ -98,11 +438,26 @@ class ForceInstall(Step):
     Установить пакет без проверки установлен ли он
     """
 
-    def __init__(self, pkgname: str, version: typing.Optional[str] = None, update: bool = False, hide: bool = False):
+    def __init__(
+        self,
+        pkgname: str,
+        version: typing.Optional[str] = None,
+        update: bool = False,
+        hide: bool = False,
+        update_ttl: int = 3600,
+    ):
+        """
+        :param pkgname: название пакета
+        :param version: версия
+        :param update: запустить apt-get update перед установкой
+        :param hide: скрыть вывод этапов
+        :param update_ttl: не запускать apt-get update если списки пакетов обновлялись не позже `update_ttl` секунд назад
+        """
         self.pkgname = pkgname
         self.version = version
         self.update = update
         self.hide = hide
+        self.update_ttl = update_ttl
 
     def get_validators(self) -> typing.List[validators.StepValidatorBase]:
         return [
@@ -110,34 +465,48 @@ class ForceInstall(Step):
         ]
 
     def run(self, c: Connection) -> None:
-        pkgname = self.pkgname
-        if self.version:
-            pkgname = f"{self.pkgname}={self.version}"
+        pkgname = pkg_spec(self.pkgname, self.version)
 
         if self.update:
-            c.run("DEBIAN_FRONTEND=noninteractive sudo apt-get update", hide=self.hide)
+            Update(ttl=self.update_ttl, hide=self.hide).run(c=c)
 
         c.run(f"DEBIAN_FRONTEND=noninteractive sudo apt-get install -y {pkgname}", hide=self.hide)
+        _invalidate_installed_versions(c)
 
 
 class Install(Step):
     """
     Установить пакет если он еще не установлен в системе
     """
-    def __init__(self, pkgname: str, version: typing.Optional[str] = None, update: bool = True, hide: bool = False) -> None:
+    def __init__(
+        self,
+        pkgname: str,
+        version: typing.Optional[str] = None,
+        update: bool = True,
+        hide: bool = False,
+        update_ttl: int = 3600,
+    ) -> None:
         """
         :param pkgname: название пакета
         :param version: версия
         :param update: запустить apt-get update перед установкой
         :param hide: скрыть вывод этапов
+        :param update_ttl: не запускать apt-get update если списки пакетов обновлялись не позже `update_ttl` секунд назад
         """
         self.pkgname = pkgname
         self.version = version
         self.update = update
         self.hide = hide
+        self.update_ttl = update_ttl
 
         self.is_package_installed = IsPackageInstalled(pkgname=self.pkgname, version=self.version)
-        self.force_install = ForceInstall(pkgname=self.pkgname, version=self.version, update=self.update, hide=self.hide)
+        self.force_install = ForceInstall(
+            pkgname=self.pkgname,
+            version=self.version,
+            update=self.update,
+            hide=self.hide,
+            update_ttl=self.update_ttl,
+        )
 
     def get_validators(self) -> typing.List[validators.StepValidatorBase]:
         return self.is_package_installed.get_validators() + self.force_install.get_validators()
@@ -155,28 +524,51 @@ class Install(Step):
                     print(f"{self.pkgname} already installed")
             return False
 
-        ForceInstall(pkgname=self.pkgname, version=self.version, update=self.update, hide=self.hide).run(c=c)
+        self.force_install.run(c=c)
         return True
 
 
+def _parse_pkg_spec(spec: str) -> typing.Tuple[str, typing.Optional[str]]:
+    """
+    Разобрать строку пакета `name` или `name=version` в пару `(name, version)`
+    """
+    pkgname, sep, version = spec.partition("=")
+    return pkgname, (version if sep else None)
+
+
 class InstallMultiple(Step):
     """
     Установить несколько пакетов, если они не установлены
     """
 
-    def __init__(self, pkg_names: typing.List[str], update: bool = True, hide: bool = False) -> None:
+    def __init__(
+        self,
+        pkg_names: typing.List[str],
+        update: bool = True,
+        hide: bool = False,
+        single_transaction: bool = True,
+        update_ttl: int = 3600,
+    ) -> None:
         """
-        :param pkg_names: список пакетов которые нужно установить
+        :param pkg_names: список пакетов которые нужно установить, можно указать версию в виде `name=version`
         :param update: запустить apt-get update перед установкой
         :param hide: скрыть вывод этапов
+        :param single_transaction: установить все недостающие пакеты одним вызовом `apt-get install`,
+            иначе каждый пакет устанавливается отдельно
+        :param update_ttl: не запускать apt-get update если списки пакетов обновлялись не позже `update_ttl` секунд назад
         """
 
         self.pkg_names = pkg_names
         self.update = update
         self.hide = hide
+        self.single_transaction = single_transaction
+        self.update_ttl = update_ttl
+
+        self.pkg_specs = [_parse_pkg_spec(x) for x in self.pkg_names]
 
     def get_validators(self) -> typing.List[validators.StepValidatorBase]:
         return [
+            validators.CommandRequiredValidator('dpkg-query'),
             validators.CommandRequiredValidator('apt-get'),
         ]
 
@@ -184,16 +576,230 @@ class InstallMultiple(Step):
         """
         :return: `True` если хотя бы один пакет был установлен, `False` если все пакеты уже были установлен ранее
         """
-        if all([IsPackageInstalled(x).run(c=c) for x in self.pkg_names]):
+        pkgnames = [pkgname for pkgname, _ in self.pkg_specs]
+        prefetch_state(c, pkgnames, updated_at=self.update and self.update_ttl > 0)
+        installed_versions = GetInstalledPackagesVersions(pkg_names=pkgnames).run(c=c)
+        missing = [
+            (pkgname, version) for pkgname, version in self.pkg_specs
+            if not _is_installed(installed_versions[pkgname], version)
+        ]
+        if not missing:
             if not self.hide:
                 print(f"{S.BRIGHT}{', '.join(self.pkg_names)}{S.RESET_ALL}: {F.GREEN}already installed{F.RESET}")
             return False
 
         if self.update:
-            c.run("DEBIAN_FRONTEND=noninteractive sudo apt-get update", hide=self.hide)
+            Update(ttl=self.update_ttl, hide=self.hide).run(c=c)
+
+        if self.single_transaction:
+            specs = " ".join([pkg_spec(pkgname, version) for pkgname, version in missing])
+            c.run(f"DEBIAN_FRONTEND=noninteractive sudo apt-get install -y {specs}", hide=self.hide)
+            _invalidate_installed_versions(c)
+        else:
+            for pkgname, version in missing:
+                ForceInstall(pkgname=pkgname, version=version, update=False, hide=self.hide).run(c=c)
+
+        if not self.hide:
+            new_versions = GetInstalledPackagesVersions(pkg_names=pkgnames).run(c=c)
+            for pkgname, version in self.pkg_specs:
+                if (pkgname, version) not in missing:
+                    print(f"{S.BRIGHT}{pkgname}{S.RESET_ALL}: {F.GREEN}already installed{F.RESET}")
+                elif _is_installed(new_versions[pkgname], version):
+                    print(f"{S.BRIGHT}{pkgname}{S.RESET_ALL}: {F.YELLOW}installed {new_versions[pkgname]}{F.RESET}")
+                else:
+                    print(f"{S.BRIGHT}{pkgname}{S.RESET_ALL}: {F.RED}not installed{F.RESET}")
+        return True
+
+
+def _deb_package_name(deb_path: str) -> str:
+    """
+    Имя пакета из имени файла `name_version_arch.deb`
+    """
+    return os.path.basename(deb_path).split("_")[0]
+
+
+def _deb_package_version(deb_path: str) -> str:
+    """
+    Версия пакета из имени файла `name_version_arch.deb`, `apt-get download` пишет `:` эпохи как `%3a`
+    """
+    return urllib.parse.unquote(os.path.basename(deb_path).split("_")[1])
+
+
+def _select_debs(local_dir: str, pins: typing.Dict[str, typing.Optional[str]]) -> typing.Dict[str, str]:
+    """
+    Выбрать по одному .deb файлу на пакет из папки, где могут лежать несколько версий пакета
+
+    :param pins: версии пакетов, для пакета с версией берется только файл этой версии
+    :return: имя пакета -> путь до .deb файла закрепленной или самой новой версии
+    """
+    versions: typing.Dict[str, typing.Dict[str, str]] = {}
+    for filename in os.listdir(local_dir):
+        if filename.endswith(".deb") and filename.count("_") == 2:
+            versions.setdefault(_deb_package_name(filename), {})[_deb_package_version(filename)] = os.path.join(local_dir, filename)
+
+    debs = {}
+    for pkgname, paths in versions.items():
+        pin = pins.get(pkgname)
+        if pin is not None:
+            if pin in paths:
+                debs[pkgname] = paths[pin]
+            continue
+        debs[pkgname] = paths[max(paths, key=functools.cmp_to_key(compare_versions))]
+    return debs
+
+
+class DownloadDebBundle(Step):
+    """
+    Скачать пакеты вместе со всеми зависимостями в локальную папку
+
+    Достаточно запустить один раз на любом хосте с тем же дистрибутивом,
+    дальше пакеты ставятся на остальные хосты шагом :py:class:`InstallDebBundle` без обращения к зеркалу
+    """
+
+    def __init__(
+        self,
+        pkg_names: typing.List[str],
+        local_dir: str,
+        remote_dir: str = "/tmp/carnival-debs",
+        hide: bool = True,
+    ) -> None:
+        """
+        :param pkg_names: список пакетов, можно указать версию в виде `name=version`
+        :param local_dir: локальная папка куда сохранить .deb файлы
+        :param remote_dir: папка на сервере для скачивания
+        :param hide: скрыть вывод этапов
+        """
+        self.pkg_names = pkg_names
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.hide = hide
+
+        self.pkg_specs = [_parse_pkg_spec(x) for x in self.pkg_names]
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}(local_dir={self.local_dir})"
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return [
+            validators.InlineValidator(
+                if_err_true_fn=lambda c: not self.pkg_names,
+                error_message="'pkg_names' must not be empty",
+            ),
+            validators.CommandRequiredValidator('apt-cache'),
+            validators.CommandRequiredValidator('apt-get'),
+        ]
+
+    def run(self, c: Connection) -> typing.List[str]:
+        """
+        :return: список путей до локальных .deb файлов
+        """
+        pkgnames = " ".join([pkgname for pkgname, _ in self.pkg_specs])
+        exclude = " ".join([f"-e {pkgname}" for pkgname, _ in self.pkg_specs])
+        specs = " ".join([pkg_spec(pkgname, version) for pkgname, version in self.pkg_specs])
+
+        # Full dependency closure, without virtual packages (`<name>`) and requested packages itself,
+        # they are downloaded with version pins
+        depends = (
+            "apt-cache depends --recurse --no-recommends --no-suggests --no-conflicts --no-breaks --no-replaces --no-enhances "
+            f"{pkgnames} | grep '^[a-zA-Z0-9]' | sort -u | grep -v -x -F {exclude}"
+        )
+        # Files left from previous bundles would be listed below as a part of this one
+        c.run(f"rm -rf {self.remote_dir} && mkdir -p {self.remote_dir}", hide=True)
+        c.run(f"DEBIAN_FRONTEND=noninteractive apt-get download $({depends}) {specs}", cwd=self.remote_dir, hide=self.hide)
+
+        os.makedirs(self.local_dir, exist_ok=True)
+        # TODO: c._c ;(
+        t = Transfer(c._c)  # type: ignore
+
+        local_paths = []
+        for remote_path in c.run(f"ls -1 {self.remote_dir}/*.deb", hide=True).stdout.strip().split("\n"):
+            local_path = os.path.join(self.local_dir, os.path.basename(remote_path))
+            # .deb file names contain version, same name means same package
+            if not os.path.exists(local_path):
+                t.get(remote=remote_path, local=local_path)
+                if not self.hide:
+                    print(f"{S.BRIGHT}{os.path.basename(remote_path)}{S.RESET_ALL}: {F.YELLOW}downloaded{F.RESET}")
+            local_paths.append(local_path)
+        return local_paths
+
+
+class InstallDebBundle(Step):
+    """
+    Установить пакеты из локальной папки с .deb файлами, например скачанной :py:class:`DownloadDebBundle`
+
+    На сервер заливаются только файлы пакетов, которых там еще нет,
+    хосты где все пакеты уже установлены пропускаются
+    """
+
+    def __init__(
+        self,
+        pkg_names: typing.List[str],
+        local_dir: str,
+        remote_dir: str = "/tmp/carnival-debs",
+        hide: bool = False,
+        rsync_opts: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> None:
+        """
+        :param pkg_names: список пакетов которые нужно установить, можно указать версию в виде `name=version`
+        :param local_dir: локальная папка с .deb файлами пакетов и их зависимостей
+        :param remote_dir: папка на сервере куда заливать .deb файлы
+        :param hide: скрыть вывод этапов
+        :param rsync_opts: параметры для `rsync`
+        """
+        self.pkg_names = pkg_names
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.hide = hide
+        self.rsync_opts = rsync_opts or {}
+
+        self.pkg_specs = [_parse_pkg_spec(x) for x in self.pkg_names]
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}(local_dir={self.local_dir})"
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return [
+            validators.IsDirectoryValidator(self.local_dir, on_localhost=True),
+            validators.CommandRequiredValidator('dpkg-query'),
+            validators.CommandRequiredValidator('apt-get'),
+        ]
+
+    def run(self, c: Connection) -> bool:
+        """
+        :return: `True` если хотя бы один пакет был установлен, `False` если все пакеты уже были установлен ранее
+        """
+        # Local dir may contain several versions of a package from different bundles
+        debs = _select_debs(self.local_dir, dict(self.pkg_specs))
+        pkgnames = [pkgname for pkgname, _ in self.pkg_specs]
+
+        installed_versions = GetInstalledPackagesVersions(pkg_names=list(set(pkgnames) | set(debs.keys()))).run(c=c)
+        missing = [pkgname for pkgname, version in self.pkg_specs if not _is_installed(installed_versions[pkgname], version)]
+        if not missing:
+            if not self.hide:
+                print(f"{S.BRIGHT}{', '.join(self.pkg_names)}{S.RESET_ALL}: {F.GREEN}already installed{F.RESET}")
+            return False
 
-        for pkg in self.pkg_names:
-            Install(pkgname=pkg, update=False, hide=self.hide).run(c=c)
+        # Installed dependencies are left as is, installing their .deb from bundle could downgrade them
+        to_install = [path for pkgname, path in debs.items() if pkgname in missing or installed_versions[pkgname] is None]
+        # Packages missing in bundle are installed from mirror
+        specs = [pkg_spec(pkgname, version) for pkgname, version in self.pkg_specs if pkgname in missing and pkgname not in debs]
+
+        if to_install:
+            c.run(f"mkdir -p {self.remote_dir}", hide=True)
+            shortcuts.rsync(c.host, " ".join(to_install), self.remote_dir, **self.rsync_opts)
+
+        # apt-get treats argument as .deb file only if it contains `/`
+        remote_debs = [os.path.join(".", self.remote_dir, os.path.basename(x)) for x in to_install]
+        try:
+            c.run(f"DEBIAN_FRONTEND=noninteractive sudo apt-get install -y {' '.join(remote_debs + specs)}", hide=self.hide)
+        finally:
+            _invalidate_installed_versions(c)
+            if remote_debs:
+                c.run(f"rm -f {' '.join(remote_debs)}", hide=True, warn=True)
+
+        if not self.hide:
+            for pkgname in missing:
+                print(f"{S.BRIGHT}{pkgname}{S.RESET_ALL}: {F.YELLOW}installed{F.RESET}")
         return True
 
 
@@ -221,3 +827,4 @@ class Remove(Step):
 
     def run(self, c: Connection) -> None:
         c.run(f"DEBIAN_FRONTEND=noninteractive sudo apt-get remove --auto-remove -y {' '.join(self.pkg_names)}", hide=self.hide)
+        _invalidate_installed_versions(c)
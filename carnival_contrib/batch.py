@@ -0,0 +1,137 @@
+"""
+Выполнение нескольких команд на хосте за один вызов `c.run`
+
+Каждый вызов `c.run` - это отдельный канал ssh и полный round trip до хоста,
+для шагов, которые делают много мелких проверок, это основное время выполнения.
+"""
+
+import re
+import typing
+from uuid import uuid4
+
+from carnival import Connection
+
+
+class CommandResult(typing.NamedTuple):
+    """
+    Результат выполнения команды из пакета
+    """
+
+    command: str
+    return_code: int
+    stdout: str
+    stderr: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return self.return_code == 0
+
+
+class CommandBatch:
+    """
+    Пакет команд, которые отправляются на хост одним shell-скриптом
+
+    Каждая команда выполняется в отдельном subshell, её stdout, stderr и код возврата возвращаются отдельно.
+    Если команда без `warn=True` завершилась с ошибкой, следующие команды не выполняются и выбрасывается исключение.
+
+    >>> from carnival import localhost_connection
+    >>> batch = CommandBatch()
+    >>> batch.add("mkdir -p /tmp/carnival-batch")
+    0
+    >>> is_exist = batch.add("test -d /tmp/carnival-batch", warn=True)
+    >>> is_missing = batch.add("test -d /tmp/carnival-batch/missing", warn=True)
+    >>> results = batch.run(localhost_connection)
+    >>> results[is_exist].ok, results[is_missing].ok
+    (True, False)
+    """
+
+    def __init__(self) -> None:
+        self.commands: typing.List[typing.Tuple[str, bool]] = []
+
+    def add(self, command: str, warn: bool = False) -> int:
+        """
+        Добавить команду в пакет
+
+        :param command: команда
+        :param warn: не прерывать выполнение пакета если команда завершилась с ошибкой
+        :return: индекс результата команды в списке, который вернет :py:meth:`run`
+        """
+        # Empty subshell `( )` is a syntax error, it would break the whole batch
+        if not [x for x in command.splitlines() if x.strip() and not x.strip().startswith("#")]:
+            raise ValueError(f"Empty command: {command!r}")
+        self.commands.append((command, warn))
+        return len(self.commands) - 1
+
+    def build_script(self, marker: str) -> str:
+        lines = []
+        for idx, (command, warn) in enumerate(self.commands):
+            # Newline before `)` - command may end with comment
+            # Marker is written to both streams to split stderr by commands as well
+            lines.append(f"( {command}\n) </dev/null; __rc=$?; echo; echo '{marker}' {idx} $__rc; echo >&2; echo '{marker}' {idx} >&2")
+            if not warn:
+                lines.append("[ $__rc -eq 0 ] || exit $__rc")
+        return "\n".join(lines)
+
+    def run(self, c: Connection, hide: bool = True) -> typing.List[CommandResult]:
+        """
+        Выполнить все команды пакета
+
+        :param c: Конект с хостом
+        :param hide: скрыть вывод команд
+        :return: результаты команд в порядке добавления
+        """
+        if not self.commands:
+            return []
+
+        marker = f"__carnival_batch_{uuid4().hex}__"
+        result = c.run(self.build_script(marker), hide=True, warn=True)
+
+        stderrs = _split_stderr(result.stderr, marker)
+        results: typing.List[CommandResult] = []
+        stdout_lines: typing.List[str] = []
+        marker_re = re.compile(rf"^{marker} (\d+) (\d+)$")
+        for line in result.stdout.replace("\r", "").split("\n"):
+            match = marker_re.match(line)
+            if match is None:
+                stdout_lines.append(line)
+                continue
+
+            idx, return_code = int(match.group(1)), int(match.group(2))
+            command, warn = self.commands[idx]
+            stdout = _join_section(stdout_lines)
+            stdout_lines = []
+            stderr = stderrs.get(idx, "")
+            results.append(CommandResult(command=command, return_code=return_code, stdout=stdout, stderr=stderr))
+
+            if not hide and stdout:
+                print(stdout)
+            if return_code != 0 and not warn:
+                raise RuntimeError(f"{command} failed with exit code: {return_code}, stderr: {stderr}")
+
+        if len(results) != len(self.commands):
+            raise RuntimeError(f"Batch failed with exit code: {result.return_code}, stderr: {result.stderr}")
+        return results
+
+
+def _join_section(lines: typing.List[str]) -> str:
+    # Drop newline added by `echo` before marker
+    return "\n".join(lines[:-1] if lines and lines[-1] == "" else lines)
+
+
+def _split_stderr(stderr: str, marker: str) -> typing.Dict[int, str]:
+    """
+    Разбить stderr скрипта по командам
+
+    :return: индекс команды -> её stderr
+    """
+    sections: typing.Dict[int, str] = {}
+    lines: typing.List[str] = []
+    marker_re = re.compile(rf"^{marker} (\d+)$")
+    for line in stderr.replace("\r", "").split("\n"):
+        match = marker_re.match(line)
+        if match is None:
+            lines.append(line)
+            continue
+        sections[int(match.group(1))] = _join_section(lines)
+        lines = []
+    return sections
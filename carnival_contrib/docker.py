@@ -1,4 +1,7 @@
 import os
+import shlex
+import shutil
+import subprocess
 import typing
 
 from colorama import Fore as F, Style as S  # type: ignore
@@ -7,39 +10,164 @@ from carnival import Step
 from carnival import Connection
 from carnival.steps import validators, shortcuts
 
-from carnival_contrib import apt, systemd
+from carnival_contrib import _compress, apt, systemd
+from carnival_contrib._channel import ChannelWriter, check, pipe_to
+from carnival_contrib._digest import cached_file_digest, is_same_file, remote_file_digest
+from carnival_contrib._image import ImageArchive, RemoteImage, present_layers, read_image_archive, remote_images, write_reduced_archive
+
+
+def _load_stream(c: Connection, write: typing.Callable[[typing.Any], None], compress: bool) -> None:
+    """
+    Загрузить tar-образ потоком в `docker load` на сервере, без файла на диске сервера
+
+    :param write: функция, которая пишет tar-образ в переданный ей файлоподобный объект.
+        Образ может быть сжат gzip, bzip2 или xz, `docker load` разжимает их сам
+    :param compress: сжать поток лучшим общим с сервером кодеком, образ разжимается на сервере в пайпе
+    """
+    codec = _compress.get_codec(c) if compress else None
+    command = "docker load" if codec is None else f"{codec.remote_decompress} | docker load"
+    written: typing.List[int] = []
+
+    def produce(w: ChannelWriter) -> None:
+        if codec is None:
+            write(w)
+        else:
+            writer = _compress.CompressWriter(codec, w)
+            write(writer)
+            writer.close()
+        written.append(w.bytes_written)
+
+    result = pipe_to(c, command, produce)
+    check(command, result)
+    for line in result.stdout.decode(errors="replace").splitlines():
+        print(f"{S.BRIGHT}docker load{S.RESET_ALL}: {F.YELLOW}{line.strip()}{F.RESET}")
+    method = "streamed" if codec is None else f"streamed, {codec.name}"
+    print(f"{S.BRIGHT}docker load{S.RESET_ALL}: {method}, {written[0]} bytes sent")
+
+
+def _tag_present_image(c: Connection, image_id: str, repo_tags: typing.Iterable[str], images: typing.Dict[str, RemoteImage]) -> bool:
+    """
+    Если образ уже есть на сервере, добавить ему недостающие теги
+
+    :return: есть ли образ на сервере
+    """
+    remote = images.get(image_id)
+    if remote is None:
+        return False
+
+    missing_tags = [x for x in repo_tags if x not in remote.repo_tags]
+    if missing_tags:
+        c.run(" && ".join(f"docker tag {image_id} {shlex.quote(tag)}" for tag in missing_tags), hide=True)
+    print(f"{S.BRIGHT}{image_id[:19]}{S.RESET_ALL}: {F.GREEN}already loaded{F.RESET}")
+    return True
+
+
+def _local_image_id(name: str) -> str:
+    proc = subprocess.run(["docker", "image", "inspect", "--format", "{{.Id}}", name], capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"docker image inspect {name} failed with exit code: {proc.returncode}, stderr: {proc.stderr.strip()}")
+    return proc.stdout.strip()
 
 
 class CeInstallUbuntu(Step):
     """
     Установить docker на ubuntu
     https://docs.docker.com/engine/install/ubuntu/
+
+    Состояние пакета, репозитория и ключа проверяется одним вызовом, выполняются только недостающие этапы
     """
-    def __init__(self, docker_version: typing.Optional[str] = None) -> None:
+
+    KEYRING_PATH = "/etc/apt/keyrings/docker.asc"
+    SOURCES_PATH = "/etc/apt/sources.list.d/docker.list"
+    REPO_URL = "https://download.docker.com/linux/ubuntu"
+
+    def __init__(
+        self,
+        docker_version: typing.Optional[str] = None,
+        key_path: typing.Optional[str] = None,
+        debs_dir: typing.Optional[str] = None,
+    ) -> None:
         """
         :param docker_version: версия docker-ce
+        :param key_path: локальный файл GPG-ключа репозитория docker, вместо скачивания ключа на сервере
+        :param debs_dir: локальная папка с .deb файлами docker-ce и зависимостей,
+            например скачанная :py:class:`carnival_contrib.apt.DownloadDebBundle`.
+            Пакеты ставятся из неё без обращения к репозиторию, см :py:class:`carnival_contrib.apt.InstallDebBundle`
         """
         self.docker_version = docker_version
+        self.key_path = key_path
+        self.debs_dir = debs_dir
 
     def get_validators(self) -> typing.List[validators.StepValidatorBase]:
-        return [
+        result: typing.List[validators.StepValidatorBase] = [
             validators.CommandRequiredValidator("apt-get"),
-            validators.CommandRequiredValidator("curl"),
         ]
+        if self.key_path is not None:
+            result.append(validators.IsFileValidator(self.key_path, on_localhost=True))
+        if self.debs_dir is not None:
+            result.append(validators.IsDirectoryValidator(self.debs_dir, on_localhost=True))
+        return result
 
-    def run(self, c: Connection) -> None:
+    def run(self, c: Connection) -> bool:
+        """
+        :return: `True` если docker-ce был установлен, `False` если он уже был установлен ранее
+        """
         pkgname = "docker-ce"
+        prerequisites = ["ca-certificates"] if self.key_path is not None else ["ca-certificates", "curl"]
+        repo_result, = apt.prefetch_state(
+            c, [pkgname, *prerequisites], updated_at=True,
+            extra_commands=[
+                f"grep -rqs {shlex.quote(self.REPO_URL)} /etc/apt/sources.list /etc/apt/sources.list.d/ && echo repo; "
+                f"[ -s {self.KEYRING_PATH} ] && echo key; "
+                f"apt-cache show --no-all-versions {shlex.quote(apt.pkg_spec(pkgname, self.docker_version))} >/dev/null 2>&1 "
+                "&& echo candidate; true",
+            ],
+        )
         if apt.IsPackageInstalled(pkgname=pkgname, version=self.docker_version).run(c=c):
             print(f"{S.BRIGHT}docker-ce{S.RESET_ALL}: {F.GREEN}already installed{F.RESET}")
+            return False
 
         print(f"Installing {pkgname}...")
-        c.run("sudo apt-get update")
-        c.run("sudo apt-get install -y apt-transport-https ca-certificates curl software-properties-common")
-        c.run("curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo apt-key add -")
-        c.run('sudo add-apt-repository "deb [arch=amd64] https://download.docker.com/linux/ubuntu $(lsb_release -cs) stable"')
+        state = repo_result.stdout.split()
+        # Offline install does not need repository, it is added only if key is staged
+        repo_added = "repo" not in state and (self.debs_dir is None or self.key_path is not None)
+        if repo_added:
+            if self.debs_dir is None:
+                apt.InstallMultiple(prerequisites, hide=True).run(c=c)
+            if "key" not in state:
+                self._install_key(c)
+            c.run(
+                f"echo \"deb [arch=$(dpkg --print-architecture) signed-by={self.KEYRING_PATH}] {self.REPO_URL} "
+                f"$(. /etc/os-release && echo \"$VERSION_CODENAME\") stable\" | sudo tee {self.SOURCES_PATH} >/dev/null",
+                hide=True,
+            )
 
-        apt.ForceInstall(pkgname=pkgname, version=self.docker_version, update=True, hide=True).run(c=c)
+        if self.debs_dir is not None:
+            spec = apt.pkg_spec(pkgname, self.docker_version)
+            apt.InstallDebBundle(pkg_names=[spec], local_dir=self.debs_dir, hide=True).run(c=c)
+        else:
+            # Package lists must be refreshed regardless of their age if they don't know docker-ce yet:
+            # repository was just added, or added by earlier run which failed before `apt-get update`
+            force_update = repo_added or "candidate" not in state
+            apt.ForceInstall(
+                pkgname=pkgname, version=self.docker_version, update=True, hide=True, update_ttl=0 if force_update else 3600,
+            ).run(c=c)
         print(f"{S.BRIGHT}docker-ce{S.RESET_ALL}: {F.YELLOW}installed{F.RESET}")
+        return True
+
+    def _install_key(self, c: Connection) -> None:
+        install = f"sudo install -D -m 644 /dev/stdin {self.KEYRING_PATH}"
+        if self.key_path is None:
+            c.run(f"curl -fsSL {self.REPO_URL}/gpg | {install}", hide=True)
+            return
+
+        with open(self.key_path, "rb") as f:
+            key = f.read()
+
+        def produce(w: ChannelWriter) -> None:
+            w.write(key)
+
+        check(install, pipe_to(c, install, produce))
 
 
 class ComposeInstall(Step):
@@ -85,11 +213,19 @@ class UploadImageFile(Step):
         dest_dir: str = '/tmp/',
         rm_after_load: bool = False,
         rsync_opts: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        stream: bool = False,
+        compress: bool = False,
+        skip_present: bool = True,
     ):
         """
         :param docker_image_path: tar-образ docker
         :param dest_dir: папка куда заливать
         :param rm_after_load: удалить образ после загрузки
+        :param stream: передать образ потоком прямо в `docker load` по ssh-каналу, без файла на диске сервера.
+            `dest_dir`, `rm_after_load` и `rsync_opts` не используются
+        :param compress: при передаче потоком сжать образ, если он еще не сжат
+        :param skip_present: не передавать образ, если на сервере уже есть образ с таким ID,
+            при передаче потоком не передавать слои, которые уже есть на сервере
         """
         if not dest_dir.endswith("/"):
             dest_dir += "/"
@@ -98,8 +234,13 @@ class UploadImageFile(Step):
         self.dest_dir = dest_dir
         self.rm_after_load = rm_after_load
         self.rsync_opts = rsync_opts or {}
+        self.stream = stream
+        self.compress = compress
+        self.skip_present = skip_present
 
     def get_name(self) -> str:
+        if self.stream:
+            return f"{super().get_name()}(src={self.docker_image_path}, stream=True)"
         return f"{super().get_name()}(src={self.docker_image_path}, dst={self.dest_dir})"
 
     def get_validators(self) -> typing.List[validators.StepValidatorBase]:
@@ -112,8 +253,90 @@ class UploadImageFile(Step):
         image_file_name = os.path.basename(self.docker_image_path)
         systemd.Start("docker").run(c=c)
 
-        shortcuts.rsync(c.host, self.docker_image_path, self.dest_dir, **self.rsync_opts)
+        image = read_image_archive(self.docker_image_path) if self.skip_present else None
+        images = remote_images(c) if image is not None else {}
+        if image is not None and _tag_present_image(c, image.image_id, image.repo_tags, images):
+            return
+
+        if self.stream:
+            self._load_stream(c, image, images)
+            return
+
+        local_size = os.path.getsize(self.docker_image_path)
+        remote = remote_file_digest(c, f"{self.dest_dir}{image_file_name}", expected_size=local_size)
+        if not is_same_file(remote, local_size, lambda algorithm: cached_file_digest(self.docker_image_path, algorithm)):
+            shortcuts.rsync(c.host, self.docker_image_path, self.dest_dir, **self.rsync_opts)
         c.run(f"cd {self.dest_dir}; docker load -i {image_file_name}")
 
         if self.rm_after_load:
             c.run(f"rm -rf {self.dest_dir}{image_file_name}")
+
+    def _load_stream(self, c: Connection, image: typing.Optional[ImageArchive], images: typing.Dict[str, RemoteImage]) -> None:
+        with open(self.docker_image_path, "rb") as f:
+            compress = self.compress and not _compress.is_compressed(self.docker_image_path, f.read(8))
+
+        present = present_layers(image, images.values()) if image is not None else 0
+        if image is not None and present > 0:
+            skip = image.layers[:present]
+            print(f"{S.BRIGHT}{self.docker_image_path}{S.RESET_ALL}: {present} of {len(image.layers)} layers already loaded")
+            try:
+                # Reduced archive is plain tar, it is compressed by the stream if requested
+                _load_stream(c, lambda w: write_reduced_archive(self.docker_image_path, w, skip), compress=self.compress)
+                return
+            except RuntimeError as e:
+                # Daemons with containerd image store require all layers in archive
+                print(f"{S.BRIGHT}{self.docker_image_path}{S.RESET_ALL}: {F.RED}{e}{F.RESET}, loading full image")
+
+        with open(self.docker_image_path, "rb") as f:
+            _load_stream(c, lambda w: shutil.copyfileobj(f, w, _compress.CHUNK_SIZE), compress=compress)
+
+
+class UploadImage(Step):
+    """
+    Передать образ из локального docker-демона на сервер потоком `docker save | docker load`,
+    без tar-файлов на локальном диске и на сервере
+    """
+    def __init__(self, image: str, compress: bool = False, skip_present: bool = True):
+        """
+        :param image: образ или несколько образов через пробел, например `app:1.0`
+        :param compress: сжать поток
+        :param skip_present: не передавать образы, ID которых уже есть на сервере
+        """
+        self.image = image
+        self.compress = compress
+        self.skip_present = skip_present
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}(image={self.image})"
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return [
+            validators.InlineValidator(
+                if_err_true_fn=lambda c: shutil.which("docker") is None,
+                error_message="docker is required on localhost",
+            ),
+            validators.CommandRequiredValidator("systemctl"),
+            validators.CommandRequiredValidator("docker"),
+        ]
+
+    def run(self, c: Connection) -> None:
+        systemd.Start("docker").run(c=c)
+
+        names = self.image.split()
+        if self.skip_present:
+            images = remote_images(c)
+            names = [name for name in names if not _tag_present_image(c, _local_image_id(name), [name], images)]
+            if not names:
+                return
+
+        proc = subprocess.Popen(["docker", "save", *names], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert proc.stdout is not None and proc.stderr is not None
+        stdout = proc.stdout
+        try:
+            _load_stream(c, lambda w: shutil.copyfileobj(stdout, w, _compress.CHUNK_SIZE), compress=self.compress)
+        finally:
+            proc.stdout.close()
+            stderr = proc.stderr.read().decode(errors="replace").strip()
+            return_code = proc.wait()
+        if return_code != 0:
+            raise RuntimeError(f"docker save failed with exit code: {return_code}, stderr: {stderr}")
@@ -1,17 +1,33 @@
+import logging
+import logging.handlers
 import os
+import shlex
+import threading
+import time
 import typing
-from itertools import chain
+from collections import deque
 
-from carnival import Connection
+from carnival import Connection, Host
 from carnival import Step
 from carnival.steps import validators
 
-from carnival_contrib import systemd, transfer
+from colorama import Style as S, Fore as F  # type: ignore
+
+from carnival_contrib import systemd
+from carnival_contrib._channel import check, pipe_from, pipe_to
+from carnival_contrib._templates import CachedTemplateValidator, render_cached
+from carnival_contrib._tree import TreeEntry, diff_trees, print_tree_changes, remote_tree, remote_untar_command, write_tar_bytes
+from carnival_contrib.batch import CommandBatch
+from carnival_contrib.fleet import raise_for_errors, run_on_hosts
 
 
 class UploadService(Step):
     """
     Залить docker-compose сервис и запустить
+
+    Шаблоны рендерятся локально и сравниваются с файлами на сервере одной командой,
+    измененные файлы передаются одним tar-потоком и переносятся на место только после полной распаковки.
+    Если ничего не изменилось, `docker-compose rm -f` не выполняется
     """
 
     def __init__(
@@ -42,50 +58,259 @@ class UploadService(Step):
 
         self.template_context = template_context
 
-        self.transfer_chain = []
-        for template_path, dest_fname in self.template_files:
-            self.transfer_chain.append(transfer.PutTemplate(
-                template_path=template_path,
-                remote_path=dest_fname,
-                context=self.template_context,
-            ))
-
     def get_name(self) -> str:
         return f"{super().get_name()}({self.app_dir})"
 
     def get_validators(self) -> typing.List[validators.StepValidatorBase]:
         return [
-            *list(chain(*[x.get_validators() for x in self.transfer_chain])),
+            *[CachedTemplateValidator(template_path, self.template_context) for template_path, _ in self.template_files],
             validators.CommandRequiredValidator('docker'),
             validators.CommandRequiredValidator('docker-compose'),
         ]
 
-    def run(self, c: Connection) -> typing.Any:
+    def run(self, c: Connection) -> typing.Set[str]:
+        """
+        :return: измененные файлы, пути относительно `app_dir`
+        """
         systemd.Start("docker").run(c=c)
 
-        c.run(f"mkdir -p {self.app_dir}")
+        rendered = {
+            dest_fname: render_cached(template_path, self.template_context)
+            for template_path, dest_fname in self.template_files
+        }
+        remote = remote_tree(c, self.app_dir, relpaths=rendered.keys())
+        changes = diff_trees(
+            src={dest_fname: TreeEntry(size=len(x.data), mtime=0, digest="") for dest_fname, x in rendered.items()},
+            dst=remote.entries,
+            is_same=lambda dest_fname: bool(remote.algorithm) and (
+                remote.entries[dest_fname].digest == rendered[dest_fname].digest(remote.algorithm)
+            ),
+        )
+        print_tree_changes(self.app_dir, changes)
+        if not changes.has_changes:
+            return set()
 
-        for transfer_step in self.transfer_chain:
-            transfer_step.run(c)
+        files = {dest_fname: rendered[dest_fname].data for dest_fname in changes.transferred}
+        # Templates have no mode of their own, files made executable on the host stay executable
+        command = remote_untar_command(self.app_dir, keep_modes=True)
+        check(command, pipe_to(c, command, lambda w: write_tar_bytes(w, files)))
 
         c.run("docker-compose rm -f", cwd=self.app_dir, hide=True)
+        return set(changes.transferred)
+
+
+class ContainerState(typing.NamedTuple):
+    """
+    Контейнер сервиса docker-compose
+    """
+
+    service: str
+    config_hash: str
+    running: bool
+
+
+class ServicesState(typing.NamedTuple):
+    """
+    Состояние сервисов docker-compose на сервере
+    """
+
+    docker_active: bool
+    config_hashes: typing.Optional[typing.Dict[str, str]]
+    """
+    Сервис -> хеш конфигурации из compose-файлов, `None` если docker-compose не умеет `config --hash`
+    """
+    containers: typing.List[ContainerState]
+
+
+def _services_state_batch(app_dir: str) -> CommandBatch:
+    inspect_format = (
+        '{{index .Config.Labels "com.docker.compose.service"}} '
+        '{{index .Config.Labels "com.docker.compose.config-hash"}} {{.State.Running}}'
+    )
+    batch = CommandBatch()
+    batch.add("systemctl is-active docker", warn=True)
+    batch.add(f"cd {app_dir} && docker-compose config --hash='*'", warn=True)
+    batch.add(
+        f"cd {app_dir} && ids=$(docker-compose ps -q 2>/dev/null) && "
+        f'{{ [ -z "$ids" ] || docker inspect --format {shlex.quote(inspect_format)} $ids; }}',
+        warn=True,
+    )
+    return batch
+
+
+def get_services_state(c: Connection, app_dir: str) -> ServicesState:
+    """
+    Получить состояние docker, хеши конфигурации сервисов и контейнеры проекта одним вызовом `c.run`
+
+    :param c: Конект с хостом
+    :param app_dir: Путь до папки с compose-файлами
+    """
+    active, config, inspect = _services_state_batch(app_dir).run(c)
+
+    config_hashes: typing.Optional[typing.Dict[str, str]] = None
+    if config.ok:
+        config_hashes = dict(line.split() for line in config.stdout.splitlines() if len(line.split()) == 2)
+
+    containers = []
+    for line in inspect.stdout.splitlines() if inspect.ok else []:
+        parts = line.split()
+        if len(parts) == 3:
+            containers.append(ContainerState(service=parts[0], config_hash=parts[1], running=parts[2] == "true"))
+    return ServicesState(docker_active=active.ok, config_hashes=config_hashes, containers=containers)
+
+
+def changed_services(state: ServicesState, scale: typing.Optional[typing.Dict[str, int]] = None) -> typing.Tuple[typing.List[str], bool]:
+    """
+    Сервисы, которые `docker-compose up` запустит или пересоздаст
+
+    :param state: состояние сервисов, см :py:func:`get_services_state`
+    :param scale: масштабирование сервисов
+    :return: измененные сервисы и есть ли контейнеры сервисов, которых больше нет в compose-файлах
+    """
+    assert state.config_hashes is not None
+    scale = scale or {}
+    changed = []
+    for service, config_hash in sorted(state.config_hashes.items()):
+        containers = [x for x in state.containers if x.service == service]
+        up_to_date = all(x.running and x.config_hash == config_hash for x in containers)
+        if not containers or not up_to_date or (service in scale and len(containers) != scale[service]):
+            changed.append(service)
+    has_orphans = any(x.service not in state.config_hashes for x in state.containers)
+    return changed, has_orphans
+
+
+class PullResult(typing.NamedTuple):
+    """
+    Результат скачивания образа
+    """
+
+    image: str
+    return_code: int
+    duration: float
+    error: str = ""
+    """
+    Вывод `docker pull` в stderr, если скачать не удалось
+    """
+
+
+def _pull_command(app_dir: str, services: typing.Optional[typing.List[str]], workers: int) -> str:
+    # `docker-compose config` output is normalized: services at 2 spaces indent, their keys at 4
+    only = f" {' '.join(services)} " if services is not None else ""
+    # Images of services with `build` are built locally and usually are not in any registry,
+    # they are skipped like `docker-compose pull --ignore-buildable` does
+    awk = (
+        'function flush() { if (img != "" && !build && (only == "" || index(only, " " svc " "))) print img; img = ""; build = 0 } '
+        '/^[^ ]/ { flush(); s = ($0 == "services:") } '
+        's && /^  [^ ]/ { flush(); svc = $1; sub(":$", "", svc) } '
+        's && /^    build:/ { build = 1 } '
+        's && /^    image: / { img = $2; gsub(/"/, "", img); gsub(/\\047/, "", img) } '
+        'END { flush() }'
+    )
+    # Result is a single line per image, `image rc start end stderr`, so lines of parallel pulls don't mix
+    pull = (
+        's=$(date +%s.%N); e=$(docker pull -q "$0" 2>&1 >/dev/null); rc=$?; '
+        'echo "$0 $rc $s $(date +%s.%N) $(printf "%s" "$e" | tr "\\n" " ")"'
+    )
+    return (
+        f'cd {app_dir} && config="$(docker-compose config)" && '
+        f'printf "%s\\n" "$config" | awk -v only={shlex.quote(only)} {shlex.quote(awk)} | sort -u | '
+        f"xargs -r -n 1 -P {max(1, workers)} sh -c {shlex.quote(pull)}"
+    )
+
+
+class Pull(Step):
+    """
+    Скачать образы сервисов параллельно, не трогая запущенные контейнеры
+
+    Образы скачиваются на сервере `docker pull` через `xargs -P`, время скачивания каждого образа выводится.
+    Образы сервисов с `build` не скачиваются, они собираются локально
+    """
+
+    def __init__(self, app_dir: str, services: typing.Optional[typing.List[str]] = None, workers: int = 4):
+        """
+        :param app_dir: Путь до папки с compose-файлами
+        :param services: Скачать образы только указанных сервисов, все сервисы если `None`
+        :param workers: Сколько образов скачивать одновременно
+        """
+        self.app_dir = app_dir
+        self.services = services
+        self.workers = workers
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}({self.app_dir})"
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return [
+            validators.InlineValidator(
+                if_err_true_fn=lambda c: self.services == [],
+                error_message="'services' must not be empty list, use None to pull all services",
+            ),
+            validators.CommandRequiredValidator('docker'),
+            validators.CommandRequiredValidator('docker-compose'),
+            validators.CommandRequiredValidator('xargs'),
+        ]
+
+    def run(self, c: Connection) -> typing.List[PullResult]:
+        started_at = time.time()
+        stdout = c.run(_pull_command(self.app_dir, self.services, self.workers), hide=True).stdout
+
+        results = []
+        for line in stdout.replace("\r", "").splitlines():
+            parts = line.split(" ", 4)
+            if len(parts) == 5:
+                image, return_code, start, end, error = parts
+                results.append(PullResult(
+                    image=image,
+                    return_code=int(return_code),
+                    duration=float(end) - float(start),
+                    error=error.strip(),
+                ))
+
+        for x in results:
+            if x.return_code == 0:
+                print(f"{S.BRIGHT}{x.image}{S.RESET_ALL}: {F.GREEN}pulled in {x.duration:.1f}s{F.RESET}")
+            else:
+                print(f"{S.BRIGHT}{x.image}{S.RESET_ALL}: {F.RED}pull failed in {x.duration:.1f}s: {x.error}{F.RESET}")
+
+        failed = [x.image for x in results if x.return_code != 0]
+        summary = f"{len(results) - len(failed)} images pulled"
+        if failed:
+            summary += f", {F.RED}{len(failed)} failed{F.RESET}"
+        print(f"{S.BRIGHT}{self.app_dir}{S.RESET_ALL}: {summary} in {time.time() - started_at:.1f}s")
+        if failed:
+            raise RuntimeError(f"Failed to pull images: {', '.join(failed)}")
+        return results
 
 
 class Up(Step):
+    """
+    docker-compose up -d
+
+    Хеши конфигурации сервисов сравниваются с метками запущенных контейнеров одним вызовом,
+    `docker-compose up` запускается только для измененных сервисов
+    """
+
     def __init__(
         self,
         app_dir: str,
         scale: typing.Optional[typing.Dict[str, int]] = None,
-        only: typing.Optional[typing.List[str]] = None
+        only: typing.Optional[typing.List[str]] = None,
+        pull: bool = False,
+        pull_workers: int = 4,
     ):
         """
         :param app_dir: Путь до папки назначения
         :param scale: Масштабирование сервисов при запуске, не используется если `None`
         :param only: Запустить только указанные сервисы, не используется если `None`
+        :param pull: Скачать образы параллельно до того, как будет тронут хоть один контейнер, см :py:class:`Pull`.
+            Иначе образы скачиваются `docker-compose up` во время пересоздания контейнеров
+        :param pull_workers: Сколько образов скачивать одновременно
         """
         self.app_dir = app_dir
         self.scale = scale
         self.only = only
+        self.pull = pull
+        self.pull_workers = pull_workers
 
     def get_name(self) -> str:
         return f"{super().get_name()}({self.app_dir})"
@@ -100,18 +325,200 @@ class Up(Step):
             validators.CommandRequiredValidator('docker-compose'),
         ]
 
-    def run(self, c: Connection) -> typing.Any:
-        systemd.Start("docker").run(c=c)
+    def run(self, c: Connection) -> typing.Optional[typing.List[str]]:
+        """
+        :return: запущенные или пересозданные сервисы, `None` если docker-compose не умеет `config --hash`
+            и запущены все сервисы
+        """
+        state = get_services_state(c, self.app_dir)
+        if not state.docker_active:
+            systemd.Start("docker").run(c=c)
+            state = get_services_state(c, self.app_dir)
+
+        if self.pull:
+            Pull(self.app_dir, services=self.only, workers=self.pull_workers).run(c=c)
+            # Config hash includes image ID, pulled image changes it
+            state = get_services_state(c, self.app_dir)
 
-        onlystr = ""
+        if state.config_hashes is None:
+            self._up(c, self.only or [])
+            return None
+
+        services, has_orphans = changed_services(state, self.scale)
         if self.only is not None:
-            onlystr = " ".join(self.only)
+            services = [x for x in services if x in self.only]
+        if not services and not has_orphans:
+            print(f"{S.BRIGHT}{self.app_dir}{S.RESET_ALL}: {F.GREEN}up to date{F.RESET}")
+            return []
+
+        if services:
+            print(f"{S.BRIGHT}{self.app_dir}{S.RESET_ALL}: {F.YELLOW}changed {', '.join(services)}{F.RESET}")
+        else:
+            print(f"{S.BRIGHT}{self.app_dir}{S.RESET_ALL}: {F.YELLOW}removing orphans{F.RESET}")
+        # Orphans are removed regardless of services list, but empty list means all services.
+        # Unchanged services from `only` are not recreated by `up`
+        self._up(c, services or self.only or [])
+        return services
 
+    def _up(self, c: Connection, services: typing.List[str]) -> None:
         if self.scale:
             scale_str = " ".join([f" --scale {service_name}={count}" for service_name, count in self.scale.items()])
         else:
             scale_str = ""
-        c.run(f"docker-compose up -d --remove-orphans {onlystr} {scale_str}", cwd=self.app_dir)
+        started_at = time.time()
+        c.run(f"docker-compose up -d --remove-orphans {' '.join(services)} {scale_str}", cwd=self.app_dir)
+        # Containers are recreated only inside `docker-compose up`, its duration bounds the downtime
+        print(f"{S.BRIGHT}{self.app_dir}{S.RESET_ALL}: downtime window {time.time() - started_at:.1f}s")
+
+
+def _health_command(app_dir: str, services: typing.Optional[typing.List[str]]) -> str:
+    inspect_format = (
+        '{{index .Config.Labels "com.docker.compose.service"}} {{.State.Status}} '
+        '{{if .State.Health}}{{.State.Health.Status}}{{else}}none{{end}} {{.State.ExitCode}}'
+    )
+    services_str = " ".join(services or [])
+    return (
+        f"cd {app_dir} && ids=$(docker-compose ps -q {services_str}) && "
+        f'{{ [ -z "$ids" ] || docker inspect --format {shlex.quote(inspect_format)} $ids; }}'
+    )
+
+
+class WaitHealthy(Step):
+    """
+    Дождаться когда все контейнеры сервисов будут запущены, а их healthcheck в состоянии healthy.
+    Контейнеры без healthcheck считаются здоровыми, если они запущены.
+    Контейнеры, завершившиеся с кодом 0 (одноразовые сервисы, например миграции), не учитываются
+    """
+
+    def __init__(
+        self,
+        app_dir: str,
+        services: typing.Optional[typing.List[str]] = None,
+        timeout_sec: int = 60,
+        interval_sec: int = 3,
+    ):
+        """
+        :param app_dir: Директория где лежит docker-compose.yml
+        :param services: сервисы, все сервисы проекта если `None`
+        :param timeout_sec: таймаут в секундах
+        :param interval_sec: период опроса состояния в секундах
+        """
+        self.app_dir = app_dir
+        self.services = services
+        self.timeout_sec = timeout_sec
+        self.interval_sec = interval_sec
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}({self.app_dir})"
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return [
+            validators.CommandRequiredValidator('docker'),
+            validators.CommandRequiredValidator('docker-compose'),
+        ]
+
+    def run(self, c: Connection) -> None:
+        start_at = time.time()
+        command = _health_command(self.app_dir, self.services)
+        while True:
+            # service, container status, health status, exit code
+            containers = [line.split() for line in c.run(command, hide=True).stdout.splitlines() if len(line.split()) == 4]
+            # `docker-compose ps -q` lists stopped containers too, finished one-shot services are never running
+            states = [(service, status, health) for service, status, health, code in containers if (status, code) != ("exited", "0")]
+            unhealthy = sorted({service for service, _, health in states if health == "unhealthy"})
+            if unhealthy:
+                raise RuntimeError(f"Unhealthy services: {', '.join(unhealthy)}")
+            if containers and all(status == "running" and health in ("healthy", "none") for _, status, health in states):
+                print(f"{S.BRIGHT}{self.app_dir}{S.RESET_ALL}: {F.GREEN}healthy{F.RESET}")
+                return
+
+            if time.time() - start_at > self.timeout_sec:
+                waiting = sorted({service for service, status, health in states if status != "running" or health == "starting"})
+                raise TimeoutError(f"Service health wait timeout: {', '.join(waiting) or 'no containers'}")
+            time.sleep(self.interval_sec)
+
+
+class RollingDeploy(Step):
+    """
+    Залить и запустить docker-compose сервис на многих хостах партиями
+
+    На каждом хосте партии выполняются :py:class:`UploadService`, :py:class:`Up` и :py:class:`WaitHealthy`,
+    следующая партия начинается только когда все хосты предыдущей здоровы.
+    Если на каком-то хосте партии произошла ошибка, развертывание останавливается, остальные хосты не трогаются.
+
+    Шаг сам подключается к хостам `hosts`, а не к хосту задачи,
+    его нужно запускать один раз, например на localhost, как шаги :py:mod:`carnival_contrib.fleet`
+    """
+
+    def __init__(
+        self,
+        hosts: typing.Iterable[Host],
+        app_dir: str,
+        template_files: typing.List[typing.Union[str, typing.Tuple[str, str]]],
+        template_context: typing.Dict[str, typing.Any],
+        batch_size: int = 1,
+        workers: typing.Optional[int] = None,
+        scale: typing.Optional[typing.Dict[str, int]] = None,
+        pull: bool = True,
+        health_timeout_sec: int = 60,
+    ):
+        """
+        :param hosts: хосты
+        :param app_dir: Путь до папки назначения
+        :param template_files: Список jinja2-шаблонов, см :py:class:`UploadService`
+        :param template_context: Контекст шаблонов, один на все шаблоны
+        :param batch_size: сколько хостов обновлять за раз
+        :param workers: сколько хостов партии обновлять одновременно, по умолчанию все хосты партии
+        :param scale: Масштабирование сервисов при запуске, не используется если `None`
+        :param pull: скачать образы до пересоздания контейнеров, см :py:class:`Up`
+        :param health_timeout_sec: сколько секунд ждать пока сервисы хоста станут здоровыми
+        """
+        self.hosts = list(hosts)
+        self.upload = UploadService(app_dir, template_files, template_context)
+        self.up = Up(app_dir, scale=scale, pull=pull)
+        self.wait_healthy = WaitHealthy(app_dir, timeout_sec=health_timeout_sec)
+        self.app_dir = app_dir
+        self.batch_size = batch_size
+        self.workers = workers
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}({self.app_dir}, hosts={len(self.hosts)}, batch_size={self.batch_size})"
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return [
+            validators.InlineValidator(
+                if_err_true_fn=lambda c: not self.hosts,
+                error_message="'hosts' must not be empty",
+            ),
+            validators.InlineValidator(
+                if_err_true_fn=lambda c: self.batch_size < 1,
+                error_message="'batch_size' must be positive",
+            ),
+            # Checks of commands would run against the host of the task, not deployed hosts.
+            # The rest, like local templates, must fail before the first batch is touched
+            *[
+                x for step in (self.upload, self.up, self.wait_healthy) for x in step.get_validators()
+                if not isinstance(x, validators.CommandRequiredValidator)
+            ],
+        ]
+
+    def _deploy(self, c: Connection) -> None:
+        self.upload.run(c=c)
+        self.up.run(c=c)
+        self.wait_healthy.run(c=c)
+
+    def run(self, c: Connection) -> None:
+        for start in range(0, len(self.hosts), self.batch_size):
+            batch = self.hosts[start:start + self.batch_size]
+            print(f"{S.BRIGHT}{self.app_dir}{S.RESET_ALL}: deploying to {', '.join(x.addr for x in batch)}")
+            results = run_on_hosts(batch, self._deploy, workers=self.workers or len(batch))
+            try:
+                raise_for_errors(results)
+            except RuntimeError:
+                left = len(self.hosts) - start - len(batch)
+                print(f"{S.BRIGHT}{self.app_dir}{S.RESET_ALL}: {F.RED}deploy stopped, {left} hosts left untouched{F.RESET}")
+                raise
+        print(f"{S.BRIGHT}{self.app_dir}{S.RESET_ALL}: {F.GREEN}deployed to {len(self.hosts)} hosts{F.RESET}")
 
 
 class Ps(Step):
@@ -245,3 +652,186 @@ class LogsServices(Step):
 
     def run(self, c: Connection) -> typing.Any:
         c.run(f"docker-compose logs -f --tail={self.tail} {self.services}", cwd=self.app_dir)
+
+
+class FleetLogs(Step):
+    """
+    Следить за логами сервисов на многих хостах сразу
+
+    С каждого хоста логи читаются своим ssh-каналом в отдельном потоке, каждая строка выводится
+    с префиксом `<хост>/<имя контейнера>`, как его выводит `docker-compose logs`, например `app_web_1`:
+    имя сервиса из имени контейнера однозначно не выделить, в именах проекта и сервиса тоже бывают `_` и `-`.
+    У каждого потока логов свой буфер ограниченного размера,
+    если вывод не успевает, самые старые строки отбрасываются, а не тормозят чтение с хостов.
+
+    Шаг сам подключается к хостам `hosts`, а не к хосту задачи,
+    его нужно запускать один раз, например на localhost, как шаги :py:mod:`carnival_contrib.fleet`
+    """
+
+    def __init__(
+        self,
+        hosts: typing.Iterable[Host],
+        app_dir: str,
+        services: typing.Optional[typing.List[str]] = None,
+        tail: int = 20,
+        grep: typing.Optional[str] = None,
+        follow: bool = True,
+        buffer_lines: int = 1000,
+        log_file: typing.Optional[str] = None,
+        log_file_max_bytes: int = 100 * 1024 * 1024,
+        log_file_backup_count: int = 5,
+    ):
+        """
+        :param hosts: хосты
+        :param app_dir: Application remote directory
+        :param services: сервисы, все сервисы если `None`
+        :param tail: сколько последних строк вывести из каждого контейнера
+        :param grep: фильтр строк, регулярное выражение `grep -E`. Фильтрация выполняется на сервере,
+            по сети передаются только подходящие строки
+        :param follow: следить за логами до прерывания, иначе вывести текущие логи и завершиться
+        :param buffer_lines: размер буфера каждого потока логов в строках
+        :param log_file: дополнительно писать логи в локальный файл с ротацией
+        :param log_file_max_bytes: размер файла логов, после которого он ротируется
+        :param log_file_backup_count: сколько ротированных файлов логов хранить
+        """
+        self.hosts = list(hosts)
+        self.app_dir = app_dir
+        self.services = services
+        self.tail = tail
+        self.grep = grep
+        self.follow = follow
+        self.buffer_lines = buffer_lines
+        self.log_file = log_file
+        self.log_file_max_bytes = log_file_max_bytes
+        self.log_file_backup_count = log_file_backup_count
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}({self.app_dir}, hosts={len(self.hosts)})"
+
+    def get_validators(self) -> typing.List[validators.StepValidatorBase]:
+        return [
+            validators.InlineValidator(
+                if_err_true_fn=lambda c: not self.hosts,
+                error_message="'hosts' must not be empty",
+            ),
+            validators.InlineValidator(
+                if_err_true_fn=lambda c: self.buffer_lines < 1,
+                error_message="'buffer_lines' must be positive",
+            ),
+        ]
+
+    def _command(self) -> str:
+        follow = " -f" if self.follow else ""
+        services = " ".join(self.services or [])
+        command = f"cd {self.app_dir} && docker-compose logs{follow} --no-color --tail={self.tail} {services} 2>&1"
+        if self.grep is not None:
+            # No `pipefail` in plain sh, exit code of `docker-compose logs` is passed through a file.
+            # grep exits with 1 if nothing matched, that is not an error
+            command = (
+                f'rc="$(mktemp)" && {{ {command}; echo $? > "$rc"; }} | grep --line-buffered -E -e {shlex.quote(self.grep)}; '
+                'g=$?; r="$(cat "$rc")"; rm -f "$rc"; [ "$r" -eq 0 ] || exit "$r"; [ $g -le 1 ]'
+            )
+        return command
+
+    def _open_log_file(self) -> typing.Optional[logging.Logger]:
+        if self.log_file is None:
+            return None
+
+        handler = logging.handlers.RotatingFileHandler(
+            self.log_file, maxBytes=self.log_file_max_bytes, backupCount=self.log_file_backup_count, encoding="utf-8",
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger = logging.getLogger(f"{__name__}.{self.__class__.__name__}.{id(self)}")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        return logger
+
+    def run(self, c: Connection) -> None:
+        connections: typing.List[Connection] = []
+        streams: typing.Dict[str, typing.Deque[str]] = {}
+        dropped: typing.Dict[str, int] = {}
+        lock = threading.Lock()
+        has_lines = threading.Event()
+
+        def push(stream: str, line: str) -> None:
+            with lock:
+                buf = streams.setdefault(stream, deque(maxlen=self.buffer_lines))
+                if len(buf) == buf.maxlen:
+                    dropped[stream] = dropped.get(stream, 0) + 1
+                buf.append(line)
+            has_lines.set()
+
+        def follow(host: Host) -> None:
+            def consume(reader: typing.BinaryIO) -> None:
+                for raw in reader:
+                    line = raw.decode(errors="replace").rstrip("\r\n")
+                    # `docker-compose logs` prefixes lines with `<container> | `
+                    container, sep, message = line.partition(" | ")
+                    if sep:
+                        push(f"{host.addr}/{container.strip()}", message)
+                    elif line:
+                        push(host.addr, line)
+
+            try:
+                with host.connect() as hc:
+                    with lock:
+                        connections.append(hc)
+                    result = pipe_from(hc, self._command(), consume)
+                if not result.ok:
+                    push(host.addr, f"logs exited with code: {result.return_code}")
+            except Exception as e:
+                push(host.addr, f"{e.__class__.__name__}: {e}")
+
+        logger = self._open_log_file()
+        threads = [threading.Thread(target=follow, args=(host,), daemon=True) for host in self.hosts]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                alive = any(thread.is_alive() for thread in threads)
+                has_lines.wait(timeout=0.5)
+                has_lines.clear()
+                with lock:
+                    # One line per stream at a time, so one noisy stream does not hide others
+                    pending = {stream: list(buf) for stream, buf in streams.items() if buf}
+                    for buf in streams.values():
+                        buf.clear()
+                    skipped, dropped = dropped, {}
+
+                for stream, count in skipped.items():
+                    print(f"{S.BRIGHT}{stream}{S.RESET_ALL} | {F.YELLOW}{count} lines dropped{F.RESET}")
+                for stream, line in _interleave(pending):
+                    print(f"{S.BRIGHT}{stream}{S.RESET_ALL} | {line}")
+                    if logger is not None:
+                        logger.info(f"{stream} | {line}")
+                if not alive and not pending:
+                    return
+        finally:
+            # On Ctrl-C follow threads are blocked reading the channels, closed connection ends them
+            with lock:
+                opened = list(connections)
+            for hc in opened:
+                try:
+                    # TODO: c._c ;(
+                    hc._c.close()  # type: ignore
+                except Exception:
+                    pass
+            if logger is not None:
+                for handler in list(logger.handlers):
+                    handler.close()
+                    logger.removeHandler(handler)
+
+
+def _interleave(streams: typing.Dict[str, typing.List[str]]) -> typing.Iterator[typing.Tuple[str, str]]:
+    """
+    Строки потоков по очереди, по одной из каждого потока
+    """
+    idx = 0
+    while True:
+        batch = [(stream, lines[idx]) for stream, lines in streams.items() if idx < len(lines)]
+        if not batch:
+            return
+        yield from batch
+        idx += 1
@@ -0,0 +1,411 @@
+"""
+Операции сразу на многих хостах
+
+Шаги этого модуля принимают список хостов и сами подключаются к ним параллельно,
+их нужно запускать один раз, например на localhost.
+"""
+
+import os
+import shlex
+import shutil
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from colorama import Style as S, Fore as F  # type: ignore
+
+from carnival import Connection, Host, Step
+from carnival.steps import validators
+
+from carnival_contrib._channel import check, pipe_from
+from carnival_contrib._digest import CHUNK_SIZE, HASHER_ALGORITHMS, cached_file_digest, is_same_file, local_file_digest, remote_file_digest
+from carnival_contrib.transfer import PutFile
+
+
+class HostResult(typing.NamedTuple):
+    """
+    Результат выполнения на одном хосте
+    """
+
+    host: Host
+    result: typing.Any
+    error: typing.Optional[BaseException]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def run_on_hosts(
+    hosts: typing.Iterable[Host],
+    fn: typing.Callable[[Connection], typing.Any],
+    workers: int = 10,
+) -> typing.List[HostResult]:
+    """
+    Выполнить функцию на хостах параллельно, каждый хост в своем потоке и со своим конектом
+    Ошибка на одном хосте не прерывает выполнение на остальных
+
+    :param hosts: хосты
+    :param fn: функция, которая получает конект с хостом
+    :param workers: максимальное количество хостов, на которых функция выполняется одновременно
+    :return: результаты в порядке хостов
+    """
+    def _run(host: Host) -> HostResult:
+        try:
+            with host.connect() as c:
+                return HostResult(host=host, result=fn(c), error=None)
+        except Exception as e:
+            return HostResult(host=host, result=None, error=e)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(_run, hosts))
+
+
+def raise_for_errors(results: typing.Iterable[HostResult]) -> None:
+    """
+    Вывести ошибки хостов и выбросить исключение, если хотя бы на одном хосте была ошибка
+    """
+    failed = [x for x in results if not x.ok]
+    for x in failed:
+        print(f"{S.BRIGHT}{x.host.addr}{S.RESET_ALL}: {F.RED}{x.error.__class__.__name__}: {x.error}{F.RESET}")
+    if failed:
+        raise RuntimeError(f"Failed on {len(failed)} hosts: {', '.join(x.host.addr for x in failed)}")
+
+
+class ContentStore:
+    """
+    Локальное хранилище файлов по хешу содержимого, `objects/<algorithm>/<digest>`
+    Одинаковые файлы хранятся один раз, по нужным путям на них ставятся жесткие ссылки
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: папка хранилища
+        """
+        self.path = path
+        self._locks: typing.Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def object_path(self, algorithm: str, digest: str) -> str:
+        return os.path.join(self.path, "objects", algorithm, digest[:2], digest)
+
+    def has(self, algorithm: str, digest: str) -> bool:
+        return os.path.isfile(self.object_path(algorithm, digest))
+
+    def _lock(self, key: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def add(self, algorithm: str, digest: str, write: typing.Callable[[typing.BinaryIO], None]) -> bool:
+        """
+        Добавить файл в хранилище, если его там еще нет
+        Одновременные вызовы с одним хешем записывают файл один раз
+
+        :param write: функция, которая пишет содержимое файла в переданный ей файл
+        :return: добавлен ли файл
+        """
+        object_path = self.object_path(algorithm, digest)
+        with self._lock(f"{algorithm}:{digest}"):
+            if os.path.isfile(object_path):
+                return False
+
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            tmp_path = f"{object_path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    write(f)
+                if local_file_digest(tmp_path, algorithm) != digest:
+                    raise IOError(f"Content digest mismatch, expected {algorithm}:{digest}")
+                # Objects are shared by hardlinks, must not be edited in place
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, object_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return True
+
+    def link(self, algorithm: str, digest: str, dest_path: str) -> bool:
+        """
+        Поставить жесткую ссылку на файл из хранилища, если файловая система не позволяет - скопировать
+
+        :return: изменился ли `dest_path`
+        """
+        object_path = self.object_path(algorithm, digest)
+        if os.path.isfile(dest_path) and os.path.samefile(object_path, dest_path):
+            return False
+
+        dirname = os.path.dirname(dest_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = f"{dest_path}.{threading.get_ident()}.tmp"
+        try:
+            os.link(object_path, tmp_path)
+        except OSError:
+            shutil.copyfile(object_path, tmp_path)
+        os.replace(tmp_path, dest_path)
+        return True
+
+
+class FetchedFile(typing.NamedTuple):
+    """
+    Файл, скачанный с хоста
+    """
+
+    local_path: str
+    digest: str
+    downloaded: bool
+    """
+    Скачан ли файл, `False` если такое содержимое уже было в хранилище
+    """
+
+
+def _host_key(host: Host) -> str:
+    """
+    Имя хоста для путей и ключей результата, хосты с одним адресом различаются портом ssh
+    """
+    port = getattr(host, "ssh_port", 22)
+    return host.addr if port == 22 else f"{host.addr}_{port}"
+
+
+class FleetGetFile(Step):
+    """
+    Скачать файл со многих хостов параллельно, в папку `<local_dir>/<host.addr>/<remote_path>`,
+    если порт ssh не 22 - в `<local_dir>/<host.addr>_<port>/<remote_path>`
+
+    Содержимое хранится в хранилище по хешу, одинаковые файлы скачиваются и хранятся один раз,
+    в папках хостов на них ставятся жесткие ссылки
+    """
+
+    def __init__(
+        self,
+        hosts: typing.Iterable[Host],
+        remote_path: str,
+        local_dir: str,
+        store_dir: typing.Optional[str] = None,
+        workers: int = 10,
+    ):
+        """
+        :param hosts: хосты
+        :param remote_path: путь до файла на серверах
+        :param local_dir: локальная папка, файл каждого хоста сохраняется в подпапку с адресом хоста
+        :param store_dir: папка хранилища по хешу, по умолчанию `<local_dir>/.store`.
+            Для жестких ссылок должна быть на одной файловой системе с `local_dir`
+        :param workers: максимальное количество хостов, с которых файл скачивается одновременно
+        """
+        self.hosts = list(hosts)
+        self.remote_path = remote_path
+        self.local_dir = local_dir
+        self.store = ContentStore(store_dir or os.path.join(local_dir, ".store"))
+        self.workers = workers
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}(remote_path={self.remote_path}, hosts={len(self.hosts)})"
+
+    def get_validators(self) -> typing.List["validators.StepValidatorBase"]:
+        return [
+            validators.InlineValidator(
+                if_err_true_fn=lambda c: not self.hosts,
+                error_message="'hosts' must not be empty",
+            ),
+            validators.Not(
+                validators.IsFileValidator(self.local_dir, on_localhost=True),
+                error_message=f"{self.local_dir} must be directory, not file",
+            ),
+        ]
+
+    def _get(self, c: Connection) -> FetchedFile:
+        remote = remote_file_digest(c, self.remote_path)
+        if remote is None:
+            raise FileNotFoundError(f"{self.remote_path} not found")
+        if not remote.algorithm:
+            # Store is addressed by digest, file can't be put there without it
+            raise RuntimeError(f"No hash utility on host, one of: {', '.join(HASHER_ALGORITHMS)} required")
+
+        command = f'cat "$(echo {self.remote_path})"'
+
+        def download(f: typing.BinaryIO) -> None:
+            def consume(r: typing.BinaryIO) -> None:
+                shutil.copyfileobj(r, f, CHUNK_SIZE)
+
+            check(command, pipe_from(c, command, consume))
+
+        added = self.store.add(remote.algorithm, remote.digest, download)
+
+        local_path = os.path.join(self.local_dir, _host_key(c.host), self.remote_path.lstrip("/"))
+        if not self.store.link(remote.algorithm, remote.digest, local_path):
+            status = f"{F.GREEN}not changed{F.RESET}"
+        elif added:
+            status = f"{F.YELLOW}downloaded{F.RESET}"
+        else:
+            status = f"{F.YELLOW}deduplicated{F.RESET}"
+        print(f"{S.BRIGHT}{_host_key(c.host)}{S.RESET_ALL}: {local_path}: {status}")
+        return FetchedFile(local_path=local_path, digest=f"{remote.algorithm}:{remote.digest}", downloaded=added)
+
+    def run(self, c: Connection) -> typing.Dict[str, str]:
+        """
+        :return: адрес хоста (`<addr>_<port>` если порт ssh не 22) -> локальный путь до файла
+        """
+        results = run_on_hosts(self.hosts, self._get, workers=self.workers)
+        raise_for_errors(results)
+
+        files: typing.List[FetchedFile] = [x.result for x in results]
+        unique = len({x.digest for x in files})
+        downloaded = sum(1 for x in files if x.downloaded)
+        print(
+            f"{S.BRIGHT}{self.remote_path}{S.RESET_ALL}: {len(files)} hosts, {unique} unique, "
+            f"{F.YELLOW}{downloaded} downloaded{F.RESET}, {F.GREEN}{len(files) - downloaded} from store{F.RESET}"
+        )
+        return {_host_key(x.host): x.result.local_path for x in results}
+
+
+def _peer_addr(host: Host) -> str:
+    user = getattr(host, "ssh_user", None)
+    return f"{user}@{host.addr}" if user else host.addr
+
+
+class FleetPutFile(Step):
+    """
+    Закачать файл на многие хосты деревом
+
+    Файл закачивается с локальной машины только на несколько хостов-сидов,
+    дальше хосты, у которых файл уже есть, копируют его на остальные через rsync по ssh.
+    На каждом раунде количество хостов с файлом растет в `fanout + 1` раз,
+    поэтому время закачки растет логарифмически от количества хостов.
+
+    Хосты должны иметь ssh доступ друг к другу и rsync.
+    В конце хеш файла проверяется на всех хостах, при несовпадении файл закачивается с локальной машины.
+    """
+
+    def __init__(
+        self,
+        hosts: typing.Iterable[Host],
+        local_path: str,
+        remote_path: str,
+        seeds: int = 1,
+        fanout: int = 1,
+        workers: int = 10,
+        peer_addr: typing.Callable[[Host], str] = _peer_addr,
+        peer_ssh_opts: str = "-o BatchMode=yes",
+    ):
+        """
+        :param hosts: хосты
+        :param local_path: путь до локального файла
+        :param remote_path: путь куда сохранить на серверах, одинаковый на всех хостах
+        :param seeds: на сколько хостов закачать файл с локальной машины
+        :param fanout: на сколько хостов каждый хост с файлом копирует его за раунд
+        :param workers: максимальное количество хостов, на которых шаг выполняется одновременно
+        :param peer_addr: адрес хоста для ssh с других хостов, по умолчанию `<ssh_user>@<addr>`
+        :param peer_ssh_opts: опции ssh при копировании между хостами. Ключи хостов проверяются по known_hosts
+            хоста-источника, чтобы доверять незнакомым ключам при первом подключении, добавьте `-o StrictHostKeyChecking=accept-new`
+        """
+        self.hosts = list(hosts)
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.seeds = seeds
+        self.fanout = fanout
+        self.workers = workers
+        self.peer_addr = peer_addr
+        self.peer_ssh_opts = peer_ssh_opts
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}(local_path={self.local_path}, remote_path={self.remote_path}, hosts={len(self.hosts)})"
+
+    def get_validators(self) -> typing.List["validators.StepValidatorBase"]:
+        return [
+            validators.IsFileValidator(self.local_path, on_localhost=True),
+            validators.InlineValidator(
+                if_err_true_fn=lambda c: not self.hosts,
+                error_message="'hosts' must not be empty",
+            ),
+            validators.InlineValidator(
+                if_err_true_fn=lambda c: self.seeds < 1 or self.fanout < 1,
+                error_message="'seeds' and 'fanout' must be positive",
+            ),
+        ]
+
+    def _is_same(self, c: Connection, mkdir: bool = False) -> bool:
+        local_size = os.path.getsize(self.local_path)
+        remote = remote_file_digest(c, self.remote_path, expected_size=local_size, mkdir=mkdir)
+        return is_same_file(remote, local_size, lambda algorithm: cached_file_digest(self.local_path, algorithm))
+
+    def _peer_copy_command(self, target: Host) -> str:
+        port = getattr(target, "ssh_port", 22)
+        ssh = shlex.quote(f"ssh -p {port} {self.peer_ssh_opts}")
+        dest = shlex.quote(f"{self.peer_addr(target)}:{self.remote_path}")
+        return f'rsync -a -e {ssh} "$(echo {self.remote_path})" {dest}'
+
+    def _copy_to_peers(self, c: Connection, targets: typing.List[Host]) -> typing.List[Host]:
+        copied = []
+        for target in targets:
+            result = c.run(self._peer_copy_command(target), hide=True, warn=True)
+            if result.ok:
+                print(f"{S.BRIGHT}{c.host.addr} -> {target.addr}{S.RESET_ALL}: {F.YELLOW}copied{F.RESET}")
+                copied.append(target)
+            else:
+                print(f"{S.BRIGHT}{c.host.addr} -> {target.addr}{S.RESET_ALL}: {F.RED}copy failed{F.RESET}")
+        return copied
+
+    def _verify(self, c: Connection) -> bool:
+        """
+        :return: закачан ли файл повторно с локальной машины
+        """
+        if self._is_same(c):
+            return False
+        print(f"{S.BRIGHT}{c.host.addr}{S.RESET_ALL}: {F.RED}digest mismatch{F.RESET}, uploading from localhost")
+        PutFile(self.local_path, self.remote_path).run(c)
+        return True
+
+    def run(self, c: Connection) -> None:
+        # Hosts which have the file already serve as sources too, missing dirs are created for peer copies
+        probe = run_on_hosts(self.hosts, lambda hc: self._is_same(hc, mkdir=True), workers=self.workers)
+        raise_for_errors(probe)
+        holders = [x.host for x in probe if x.result]
+        pending = [x.host for x in probe if not x.result]
+        for host in holders:
+            print(f"{S.BRIGHT}{host.addr}{S.RESET_ALL}: {F.GREEN}not changed{F.RESET}")
+        if not pending:
+            return
+
+        seeds, pending = pending[:self.seeds], pending[self.seeds:]
+        results = run_on_hosts(seeds, PutFile(self.local_path, self.remote_path).run, workers=self.workers)
+        raise_for_errors(results)
+        holders.extend(seeds)
+
+        rnd = 0
+        while pending:
+            rnd += 1
+            # Keyed by host object, hosts may share `addr` and differ by port only
+            assignments: typing.Dict[int, typing.List[Host]] = {}
+            for holder in holders:
+                if not pending:
+                    break
+                assignments[id(holder)], pending = pending[:self.fanout], pending[self.fanout:]
+            print(f"{S.BRIGHT}round {rnd}{S.RESET_ALL}: {len(assignments)} sources, {sum(map(len, assignments.values()))} targets")
+
+            results = run_on_hosts(
+                [x for x in holders if id(x) in assignments],
+                lambda hc: self._copy_to_peers(hc, assignments[id(hc.host)]),
+                workers=self.workers,
+            )
+            for x in results:
+                if x.ok:
+                    holders.extend(x.result)
+                else:
+                    print(f"{S.BRIGHT}{x.host.addr}{S.RESET_ALL}: {F.RED}{x.error.__class__.__name__}: {x.error}{F.RESET}")
+            if not any(x.ok and x.result for x in results):
+                # No peer copy succeeded, the rest goes from localhost
+                break
+
+        # Hosts where peer copy failed are uploaded from localhost by verification
+        results = run_on_hosts(
+            [x.host for x in probe if not x.result],
+            self._verify,
+            workers=self.workers,
+        )
+        raise_for_errors(results)
+        uploaded = {id(x) for x in seeds} | {id(x.host) for x in results if x.result}
+        print(
+            f"{S.BRIGHT}{self.remote_path}{S.RESET_ALL}: {len(results)} hosts, "
+            f"{F.YELLOW}{len(uploaded)} uploaded from localhost{F.RESET}, "
+            f"{F.GREEN}{len(results) - len(uploaded)} copied by peers{F.RESET}"
+        )
@@ -3,6 +3,8 @@ import typing
 from carnival import Step, Connection
 from carnival.steps import validators
 
+from carnival_contrib.batch import CommandBatch
+
 
 class Mkdirs(Step):
     """
@@ -21,5 +23,7 @@ class Mkdirs(Step):
         ]
 
     def run(self, c: Connection) -> None:
+        batch = CommandBatch()
         for path in self.paths:
-            c.run(f"mkdir -p {path}")
+            batch.add(f"mkdir -p {path}")
+        batch.run(c, hide=False)
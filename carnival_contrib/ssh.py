@@ -4,6 +4,8 @@ import re
 from carnival import Step
 from carnival import Connection
 
+from carnival_contrib.batch import CommandBatch
+
 
 def _escape_for_regex(text: str) -> str:
     """
@@ -21,19 +23,17 @@ def _escape_for_regex(text: str) -> str:
     return regex
 
 
-def _is_file_contains(c: Connection, filename: str, text: str, escape: bool = True) -> bool:
+def _is_file_contains_cmd(filename: str, text: str, escape: bool = True) -> str:
     """
-    Содержит ли файл текст
+    Команда, которая проверяет содержит ли файл текст
 
-    :param c: Конект с хостом
     :param filename: путь до файла
     :param text: текст который нужно искать
     :param escape: экранировать ли текст
     """
     if escape:
         text = _escape_for_regex(text)
-    egrep_cmd = 'egrep "{}" "{}"'.format(text, filename)
-    return c.run(egrep_cmd, hide=True, warn=True).ok
+    return 'egrep "{}" "{}"'.format(text, filename)
 
 
 class AddAuthorizedKey(Step):
@@ -51,11 +51,13 @@ class AddAuthorizedKey(Step):
         self.keys_file = keys_file
 
     def run(self, c: Connection) -> bool:
-        c.run("mkdir -p ~/.ssh")
-        c.run("chmod 700 ~/.ssh")
-        c.run(f"touch {self.keys_file}")
+        batch = CommandBatch()
+        batch.add("mkdir -p ~/.ssh")
+        batch.add("chmod 700 ~/.ssh")
+        batch.add(f"touch {self.keys_file}")
+        is_contains = batch.add(_is_file_contains_cmd(self.keys_file, self.ssh_key, escape=True), warn=True)
 
-        if not _is_file_contains(c, self.keys_file, self.ssh_key, escape=True):
+        if not batch.run(c)[is_contains].ok:
             c.run(f"echo '{self.ssh_key}' >> {self.keys_file}")
             return True
         return False
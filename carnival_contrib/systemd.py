@@ -1,6 +1,25 @@
+import typing
+
 from carnival import Step
 from carnival import Connection
 
+from carnival_contrib.batch import CommandBatch
+
+
+_DAEMON_RELOAD_CMD = "sudo systemctl --system daemon-reload"
+
+
+def _run_commands(c: Connection, commands: typing.List[str]) -> None:
+    # Batch saves round trips only for several commands, single command keeps live output and errors of `c.run`
+    if len(commands) == 1:
+        c.run(commands[0])
+        return
+
+    batch = CommandBatch()
+    for command in commands:
+        batch.add(command)
+    batch.run(c, hide=False)
+
 
 class DaemonReload(Step):
     """
@@ -8,7 +27,7 @@ class DaemonReload(Step):
     """
 
     def run(self, c: Connection) -> None:
-        c.run("sudo systemctl --system daemon-reload")
+        c.run(_DAEMON_RELOAD_CMD)
 
 
 class Start(Step):
@@ -24,10 +43,10 @@ class Start(Step):
         self.reload_daemon = reload_daemon
 
     def run(self, c: Connection) -> None:
-        if self.reload_daemon:
-            DaemonReload().run(c=c)
+        commands = [_DAEMON_RELOAD_CMD] if self.reload_daemon else []
 
-        c.run(f"sudo systemctl start {self.service_name}")
+        commands.append(f"sudo systemctl start {self.service_name}")
+        _run_commands(c, commands)
 
 
 class Stop(Step):
@@ -44,10 +63,10 @@ class Stop(Step):
         self.reload_daemon = reload_daemon
 
     def run(self, c: Connection) -> None:
-        if self.reload_daemon:
-            DaemonReload().run(c=c)
+        commands = [_DAEMON_RELOAD_CMD] if self.reload_daemon else []
 
-        c.run(f"sudo systemctl stop {self.service_name}")
+        commands.append(f"sudo systemctl stop {self.service_name}")
+        _run_commands(c, commands)
 
 
 class Restart(Step):
@@ -81,13 +100,13 @@ class Enable(Step):
         self.start_now = start_now
 
     def run(self, c: Connection) -> None:
-        if self.reload_daemon:
-            DaemonReload().run(c=c)
+        commands = [_DAEMON_RELOAD_CMD] if self.reload_daemon else []
 
-        c.run(f"sudo systemctl enable {self.service_name}")
+        commands.append(f"sudo systemctl enable {self.service_name}")
 
         if self.start_now:
-            Start(self.service_name).run(c=c)
+            commands.append(f"sudo systemctl start {self.service_name}")
+        _run_commands(c, commands)
 
 
 class Disable(Step):
@@ -107,10 +126,10 @@ class Disable(Step):
         self.stop_now = stop_now
 
     def run(self, c: Connection) -> None:
-        if self.reload_daemon:
-            DaemonReload().run(c=c)
+        commands = [_DAEMON_RELOAD_CMD] if self.reload_daemon else []
 
-        c.run(f"sudo systemctl disable {self.service_name}")
+        commands.append(f"sudo systemctl disable {self.service_name}")
 
         if self.stop_now:
-            Stop(self.service_name).run(c=c)
+            commands.append(f"sudo systemctl stop {self.service_name}")
+        _run_commands(c, commands)
@@ -1,34 +1,192 @@
 import os.path
 import typing
 from io import BytesIO
-from hashlib import sha1
 
 from colorama import Style as S, Fore as F  # type: ignore
 
 from fabric.transfer import Transfer  # type: ignore
 
-from carnival import Connection, localhost_connection
-from carnival.templates import render
-from carnival.steps import shortcuts, Step, validators
+from carnival import Connection
+from carnival.steps import Step, validators
+
+from carnival_contrib import _compress, _delta
+from carnival_contrib._channel import ChannelWriter, check, pipe_from, pipe_through, pipe_to
+from carnival_contrib._chunked import upload_chunked
+from carnival_contrib._digest import (
+    cached_file_digest,
+    is_same_file,
+    remote_file_digest,
+    update_remote_manifest,
+)
+from carnival_contrib._templates import CachedTemplateValidator, render_cached
+from carnival_contrib._tree import (
+    RemoteTree,
+    TreeChanges,
+    diff_trees,
+    local_tree,
+    print_tree_changes,
+    read_tar,
+    remote_delete_command,
+    remote_tar_command,
+    remote_tree,
+    remote_untar_command,
+    write_tar,
+)
+
 
+def _put_delta(c: Connection, local_path: str, remote_path: str, mode: int) -> typing.Optional[typing.Tuple[str, int]]:
+    """
+    Закачать только изменившиеся блоки файла
+
+    :param mode: права файла, патч сохраняет права старой версии файла на сервере
+    :return: способ передачи и сколько байт передано в обе стороны, `None` если передать разницу не получилось
+    """
+    signatures: typing.List[typing.Optional[_delta.Signature]] = []
+    command = _delta.remote_command("signature", remote_path)
+    result = pipe_from(c, command, lambda r: signatures.append(_delta.read_signature(r)))
+    if result.return_code == 127 or not signatures or signatures[0] is None:
+        # No python3 on host
+        return None
+    check(f"delta signature {remote_path}", result)
+    signature = signatures[0]
+
+    written: typing.List[int] = []
+    with open(local_path, "rb") as f:
+        data = _delta.open_map(f)
+        ops = _delta.compute_delta(data, signature)
+        if all(idx < 0 for idx, _, _ in ops):
+            # Nothing in common, plain upload is cheaper
+            return None
+        command = f'{_delta.remote_command("patch", remote_path)} && chmod {mode:o} "$(echo {remote_path})"'
+        result = pipe_to(c, command, lambda w: written.append(_delta.write_delta(w, data, ops, signature.block_size)))
+    check(f"delta patch {remote_path}", result)
+    return "delta", signature.wire_size + written[0]
+
+
+def _get_delta(c: Connection, remote_path: str, local_path: str) -> typing.Optional[typing.Tuple[str, int]]:
+    """
+    Скачать только изменившиеся блоки файла
 
-def _file_sha1sum(c: Connection, fpath: str) -> typing.Optional[str]:
-    if not shortcuts.is_file(c, fpath):
+    :return: способ передачи и сколько байт передано в обе стороны, `None` если передать разницу не получилось
+    """
+    written: typing.List[int] = []
+    received: typing.List[typing.Optional[int]] = []
+    result = pipe_through(
+        c,
+        _delta.remote_command("delta", remote_path),
+        produce=lambda w: written.append(_delta.write_signature(local_path, w)),
+        consume=lambda r: received.append(_delta.apply_delta(r, local_path)),
+    )
+    if result.return_code == 127 or not received or received[0] is None:
+        # No python3 on host
         return None
-    return c.run(f"cat {fpath} | shasum -a1", hide=True).stdout.strip(" -\t\n")
+    check(f"delta {remote_path}", result)
+    return "delta", sum(written) + received[0]
+
+
+def _put_compressed(
+    c: Connection,
+    chunks: typing.Iterable[bytes],
+    remote_path: str,
+    mode: typing.Optional[int] = None,
+) -> typing.Optional[typing.Tuple[str, int]]:
+    """
+    Закачать данные сжатым потоком, данные разжимаются на сервере в пайпе
+
+    :param chunks: данные
+    :param mode: права файла, если `None` - остаются права существующего файла
+    :return: кодек и сколько сжатых байт передано, `None` если нет общего с сервером кодека
+    """
+    codec = _compress.get_codec(c)
+    if codec is None:
+        return None
+
+    if mode is not None:
+        chmod = f'chmod {mode:o} "$p.carnival-tmp"'
+    else:
+        chmod = '{ [ ! -f "$p" ] || chmod --reference="$p" "$p.carnival-tmp"; }'
+    command = (
+        f'p="$(echo {remote_path})"; '
+        f'{codec.remote_decompress} > "$p.carnival-tmp" && {chmod} && mv "$p.carnival-tmp" "$p" || '
+        '{ rc=$?; rm -f "$p.carnival-tmp"; exit $rc; }'
+    )
+    written: typing.List[int] = []
+
+    def produce(w: ChannelWriter) -> None:
+        for data in _compress.compress_chunks(codec, chunks):
+            w.write(data)
+        written.append(w.bytes_written)
+
+    check(f"{codec.remote_decompress} > {remote_path}", pipe_to(c, command, produce))
+    return codec.name, written[0]
+
+
+def _get_compressed(c: Connection, remote_path: str, local_path: str) -> typing.Optional[typing.Tuple[str, int]]:
+    """
+    Скачать файл сжатым потоком, файл сжимается на сервере в пайпе
+
+    :return: кодек и сколько сжатых байт передано, `None` если нет общего с сервером кодека
+    """
+    codec = _compress.get_codec(c)
+    if codec is None:
+        return None
+
+    # File mode goes to stderr, to keep it like `Transfer.get` does
+    command = f'p="$(echo {remote_path})"; stat -c %a "$p" >&2 && {codec.remote_compress} < "$p"'
+    tmp_path = f"{local_path}.carnival-tmp"
+    received: typing.List[int] = []
+
+    def consume(r: typing.BinaryIO) -> None:
+        with open(tmp_path, "wb") as f:
+            received.append(_compress.decompress_stream(codec, r, f))
+
+    try:
+        result = pipe_from(c, command, consume)
+        check(f"{codec.remote_compress} < {remote_path}", result)
+        os.chmod(tmp_path, int(result.stderr.split()[0], 8))
+        os.replace(tmp_path, local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return codec.name, received[0]
+
+
+def _print_transferred(path: str, action: str, transferred: typing.Tuple[str, int], size: int) -> None:
+    method, transferred_bytes = transferred
+    saved = 100 - transferred_bytes * 100 // size if size else 0
+    print(
+        f"{S.BRIGHT}{path}{S.RESET_ALL}: {F.YELLOW}{action}{F.RESET} "
+        f"({method}, transferred {transferred_bytes} of {size} bytes, saved {saved}%)"
+    )
 
 
 class GetFile(Step):
     """
     Скачать файл с удаленного сервера на локальный диск
     """
-    def __init__(self, remote_path: str, local_path: str):
+    def __init__(
+        self,
+        remote_path: str,
+        local_path: str,
+        remote_manifest: typing.Optional[str] = None,
+        delta: bool = False,
+        compress: bool = False,
+    ):
         """
         :param remote_path: Путь до файла на сервере
         :param local_path: Локальный путь назначения
+        :param remote_manifest: путь до манифеста хешей на сервере, если размер и mtime файла не менялись,
+            хеш берется из манифеста вместо повторного хеширования файла. Не используется если `None`
+        :param delta: если локальный файл уже есть, передать только изменившиеся блоки, как rsync.
+            Нужен python3 на сервере, без него файл скачивается целиком
+        :param compress: передать файл сжатым потоком zstd, lz4 или gzip, смотря что есть на сервере.
+            Уже сжатые файлы передаются как есть
         """
         self.remote_path = remote_path
         self.local_path = local_path
+        self.remote_manifest = remote_manifest
+        self.delta = delta
+        self.compress = compress
 
     def get_name(self) -> str:
         return f"{super().get_name()}(remote_path={self.remote_path}, local_path={self.local_path})"
@@ -47,19 +205,38 @@ class GetFile(Step):
         # TODO: c._c ;(
         t = Transfer(c._c)  # type: ignore
 
-        remote_sha1 = _file_sha1sum(c, self.remote_path)
-        local_sha1 = _file_sha1sum(localhost_connection, self.local_path)
-        if remote_sha1 is not None and local_sha1 is not None:
-            if remote_sha1 == local_sha1:
+        def local_digest(algorithm: str) -> str:
+            return cached_file_digest(self.local_path, algorithm)
+
+        remote = None
+        if os.path.isfile(self.local_path):
+            local_size = os.path.getsize(self.local_path)
+            remote = remote_file_digest(c, self.remote_path, expected_size=local_size, manifest=self.remote_manifest)
+            if is_same_file(remote, local_size, local_digest):
+                if self.remote_manifest is not None and remote is not None and not remote.from_manifest:
+                    update_remote_manifest(c, self.remote_manifest, self.remote_path, remote, local_digest)
                 print(f"{S.BRIGHT}{self.remote_path}{S.RESET_ALL}: {F.GREEN}not changed{F.RESET}")
                 return
 
         # Create dirs if needed
         dirname = os.path.dirname(self.local_path)
-        localhost_connection.run(f"mkdir -p {dirname}", hide=True)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        transferred = None
+        if self.delta and remote is not None and remote.size > 0 and os.path.getsize(self.local_path) > 0:
+            transferred = _get_delta(c, self.remote_path, self.local_path)
+        if transferred is None and self.compress and _compress.should_compress(self.remote_path, remote.size if remote else None):
+            transferred = _get_compressed(c, self.remote_path, self.local_path)
+
+        if transferred is None:
+            t.get(remote=self.remote_path, local=self.local_path)
+            print(f"{S.BRIGHT}{self.remote_path}{S.RESET_ALL}: {F.YELLOW}downloaded{F.RESET}")
+        else:
+            _print_transferred(self.remote_path, "downloaded", transferred, os.path.getsize(self.local_path))
 
-        t.get(remote=self.remote_path, local=self.local_path)
-        print(f"{S.BRIGHT}{self.remote_path}{S.RESET_ALL}: {F.YELLOW}downloaded{F.RESET}")
+        if self.remote_manifest is not None:
+            update_remote_manifest(c, self.remote_manifest, self.remote_path, remote, local_digest)
 
 
 class PutFile(Step):
@@ -67,13 +244,35 @@ class PutFile(Step):
     Закачать файл на сервер
 
     """
-    def __init__(self, local_path: str, remote_path: str, ):
+    def __init__(
+        self,
+        local_path: str,
+        remote_path: str,
+        remote_manifest: typing.Optional[str] = None,
+        delta: bool = False,
+        compress: bool = False,
+        chunk_size: typing.Optional[int] = None,
+        channels: int = 4,
+    ):
         """
         :param local_path: путь до локального файла
         :param remote_path: путь куда сохранить на сервере
+        :param remote_manifest: путь до манифеста хешей на сервере, см :py:class:`GetFile`
+        :param delta: если файл на сервере уже есть, передать только изменившиеся блоки, как rsync.
+            Нужен python3 на сервере, без него файл закачивается целиком
+        :param compress: передать файл сжатым потоком, см :py:class:`GetFile`
+        :param chunk_size: закачивать файлы больше этого размера кусками параллельно по нескольким sftp-каналам,
+            с проверкой хеша каждого куска. Прерванная закачка продолжается с уже закачанных кусков.
+            Не используется если `None`
+        :param channels: количество параллельных sftp-каналов при закачке кусками
         """
         self.local_path = local_path
         self.remote_path = remote_path
+        self.remote_manifest = remote_manifest
+        self.delta = delta
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.channels = channels
 
     def get_name(self) -> str:
         return f"{super().get_name()}(local_path={self.local_path}, remote_path={self.remote_path})"
@@ -92,68 +291,234 @@ class PutFile(Step):
         # TODO: c._c ;(
         t = Transfer(c._c)  # type: ignore
 
-        remote_sha1 = _file_sha1sum(c, self.remote_path)
-        local_sha1 = _file_sha1sum(localhost_connection, self.local_path)
-        if remote_sha1 is not None and local_sha1 is not None:
-            if remote_sha1 == local_sha1:
-                print(f"{S.BRIGHT}{self.remote_path}{S.RESET_ALL}: {F.GREEN}not changed{F.RESET}")
-                return
-
         # Create dirs if needed
-        dirname = os.path.dirname(self.remote_path)
-        c.run(f"mkdir -p {dirname}", hide=True)
+        local_size = os.path.getsize(self.local_path)
+        remote = remote_file_digest(
+            c, self.remote_path, expected_size=local_size, mkdir=True, manifest=self.remote_manifest,
+        )
+
+        def local_digest(algorithm: str) -> str:
+            return cached_file_digest(self.local_path, algorithm)
+
+        if is_same_file(remote, local_size, local_digest):
+            if self.remote_manifest is not None and remote is not None and not remote.from_manifest:
+                update_remote_manifest(c, self.remote_manifest, self.remote_path, remote, local_digest)
+            print(f"{S.BRIGHT}{self.remote_path}{S.RESET_ALL}: {F.GREEN}not changed{F.RESET}")
+            return
+
+        transferred = None
+        if self.chunk_size is not None and local_size > self.chunk_size:
+            mode = os.stat(self.local_path).st_mode & 0o7777
+            result = upload_chunked(
+                c, self.local_path, self.remote_path,
+                size=local_size, mode=mode, chunk_size=self.chunk_size, channels=self.channels,
+            )
+            transferred = (f"chunked, {result.uploaded} of {result.total} chunks", result.uploaded_bytes)
+        if transferred is None and self.delta and remote is not None and remote.size > 0 and local_size > 0:
+            transferred = _put_delta(c, self.local_path, self.remote_path, mode=os.stat(self.local_path).st_mode & 0o7777)
+        if transferred is None and self.compress and _compress.should_compress_file(self.local_path):
+            with open(self.local_path, "rb") as f:
+                mode = os.fstat(f.fileno()).st_mode & 0o7777
+                transferred = _put_compressed(c, _compress.read_chunks(f), self.remote_path, mode=mode)
+
+        if transferred is None:
+            t.put(local=self.local_path, remote=self.remote_path)
+            print(f"{S.BRIGHT}{self.remote_path}{S.RESET_ALL}: {F.YELLOW}uploaded{F.RESET}")
+        else:
+            _print_transferred(self.remote_path, "uploaded", transferred, local_size)
 
-        t.put(local=self.local_path, remote=self.remote_path)
-        print(f"{S.BRIGHT}{self.remote_path}{S.RESET_ALL}: {F.YELLOW}uploaded{F.RESET}")
+        if self.remote_manifest is not None:
+            update_remote_manifest(c, self.remote_manifest, self.remote_path, remote, local_digest)
 
 
 class PutTemplate(Step):
     """
     Отрендерить файл с помощью jinja-шаблонов и закачать на сервер
     См раздел templates.
+
+    Шаблон с одинаковым контекстом рендерится один раз за запуск, для всех хостов.
     """
 
-    def __init__(self, template_path: str, remote_path: str, context: typing.Dict[str, typing.Any]):
+    def __init__(
+        self,
+        template_path: str,
+        remote_path: str,
+        context: typing.Dict[str, typing.Any],
+        remote_manifest: typing.Optional[str] = None,
+        compress: bool = False,
+    ):
         """
         :param template_path: путь до локального файла jinja
         :param remote_path: путь куда сохранить на сервере
         :param context: контекс для рендеринга jinja2
+        :param remote_manifest: путь до манифеста хешей на сервере, см :py:class:`GetFile`
+        :param compress: передать файл сжатым потоком, см :py:class:`GetFile`
         """
         self.template_path = template_path
         self.remote_path = remote_path
         self.context = context
+        self.remote_manifest = remote_manifest
+        self.compress = compress
 
     def get_name(self) -> str:
         return f"{super().get_name()}(template_path={self.template_path})"
 
     def get_validators(self) -> typing.List["validators.StepValidatorBase"]:
         return [
-            validators.TemplateValidator(self.template_path, context=self.context),
+            CachedTemplateValidator(self.template_path, context=self.context),
         ]
 
     def run(self, c: "Connection") -> None:
-        filestr = render(template_path=self.template_path, **self.context)
-        remote_sha1 = _file_sha1sum(c, self.remote_path)
-        local_sha1 = sha1(filestr.encode()).hexdigest()
+        rendered = render_cached(self.template_path, self.context)
+        filebytes = rendered.data
+        # Create dirs if needed
+        remote = remote_file_digest(
+            c, self.remote_path, expected_size=len(filebytes), mkdir=True, manifest=self.remote_manifest,
+        )
 
-        if remote_sha1 is not None and local_sha1 is not None:
-            if remote_sha1 == local_sha1:
-                print(f"{S.BRIGHT}{self.template_path}{S.RESET_ALL}: {F.GREEN}not changed{F.RESET}")
-                return
+        local_digest = rendered.digest
+        if is_same_file(remote, len(filebytes), local_digest):
+            if self.remote_manifest is not None and remote is not None and not remote.from_manifest:
+                update_remote_manifest(c, self.remote_manifest, self.remote_path, remote, local_digest)
+            print(f"{S.BRIGHT}{self.template_path}{S.RESET_ALL}: {F.GREEN}not changed{F.RESET}")
+            return
 
-        # Create dirs if needed
-        dirname = os.path.dirname(self.remote_path)
-        c.run(f"mkdir -p {dirname}", hide=True)
+        transferred = None
+        if self.compress and _compress.should_compress(self.remote_path, len(filebytes), filebytes[:8]):
+            transferred = _put_compressed(c, [filebytes], self.remote_path)
 
-        # TODO: c._c ;(
-        t = Transfer(c._c)  # type: ignore
-        t.put(local=BytesIO(filestr.encode()), remote=self.remote_path)
+        if transferred is None:
+            # TODO: c._c ;(
+            t = Transfer(c._c)  # type: ignore
+            t.put(local=BytesIO(filebytes), remote=self.remote_path)
+            print(f"{S.BRIGHT}{self.template_path}{S.RESET_ALL}: {F.YELLOW}uploaded{F.RESET}")
+        else:
+            _print_transferred(self.template_path, "uploaded", transferred, len(filebytes))
+
+        if self.remote_manifest is not None:
+            update_remote_manifest(c, self.remote_manifest, self.remote_path, remote, local_digest)
+
+
+def _is_same_as_remote(remote: RemoteTree, local_dir: str, relpath: str) -> bool:
+    digest = remote.entries[relpath].digest
+    if not digest or not remote.algorithm:
+        return False
+    return digest == cached_file_digest(os.path.join(local_dir, relpath), remote.algorithm)
+
+
+class PutDirectory(Step):
+    """
+    Залить папку на сервер
+
+    Листинг папки на сервере с хешами файлов получается одной командой,
+    измененные файлы передаются одним tar-потоком и переносятся на место только после полной распаковки
+    """
+
+    def __init__(self, local_dir: str, remote_dir: str, delete: bool = False):
+        """
+        :param local_dir: путь до локальной папки
+        :param remote_dir: путь до папки на сервере
+        :param delete: удалить на сервере файлы, которых нет в локальной папке
+        """
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.delete = delete
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}(local_dir={self.local_dir}, remote_dir={self.remote_dir})"
+
+    def get_validators(self) -> typing.List["validators.StepValidatorBase"]:
+        return [
+            validators.IsDirectoryValidator(self.local_dir, on_localhost=True),
+            validators.Not(
+                validators.IsFileValidator(self.remote_dir),
+                error_message=f"{self.remote_dir} must be directory, not file",
+            )
+        ]
+
+    def run(self, c: "Connection") -> TreeChanges:
+        """
+        :return: изменения папки на сервере
+        """
+        remote = remote_tree(c, self.remote_dir)
+        changes = diff_trees(
+            src=local_tree(self.local_dir),
+            dst=remote.entries,
+            is_same=lambda relpath: _is_same_as_remote(remote, self.local_dir, relpath),
+            delete=self.delete,
+        )
+
+        if changes.transferred:
+            command = remote_untar_command(self.remote_dir, deleted=changes.deleted)
+            check(command, pipe_to(c, command, lambda w: write_tar(w, self.local_dir, changes.transferred)))
+        elif changes.deleted:
+            c.run(remote_delete_command(self.remote_dir, changes.deleted), hide=True)
+
+        print_tree_changes(self.remote_dir, changes)
+        return changes
+
+
+class GetDirectory(Step):
+    """
+    Скачать папку с сервера на локальный диск
+
+    Листинг папки на сервере с хешами файлов получается одной командой,
+    измененные файлы передаются одним tar-потоком
+    """
+
+    def __init__(self, remote_dir: str, local_dir: str, delete: bool = False):
+        """
+        :param remote_dir: путь до папки на сервере
+        :param local_dir: путь до локальной папки
+        :param delete: удалить локально файлы, которых нет в папке на сервере
+        """
+        self.remote_dir = remote_dir
+        self.local_dir = local_dir
+        self.delete = delete
+
+    def get_name(self) -> str:
+        return f"{super().get_name()}(remote_dir={self.remote_dir}, local_dir={self.local_dir})"
+
+    def get_validators(self) -> typing.List["validators.StepValidatorBase"]:
+        return [
+            validators.IsDirectoryValidator(self.remote_dir),
+            validators.Not(
+                validators.IsFileValidator(self.local_dir, on_localhost=True),
+                error_message=f"{self.local_dir} must be directory, not file",
+            )
+        ]
+
+    def run(self, c: "Connection") -> TreeChanges:
+        """
+        :return: изменения локальной папки
+        """
+        remote = remote_tree(c, self.remote_dir)
+        changes = diff_trees(
+            src=remote.entries,
+            dst=local_tree(self.local_dir),
+            is_same=lambda relpath: _is_same_as_remote(remote, self.local_dir, relpath),
+            delete=self.delete,
+        )
+
+        if changes.transferred:
+            os.makedirs(self.local_dir, exist_ok=True)
+            command = remote_tar_command(self.remote_dir, changes.transferred)
+
+            def consume(r: typing.BinaryIO) -> None:
+                read_tar(r, self.local_dir, changes.transferred)
+
+            check(command, pipe_from(c, command, consume))
+        for relpath in changes.deleted:
+            os.remove(os.path.join(self.local_dir, relpath))
 
-        print(f"{S.BRIGHT}{self.template_path}{S.RESET_ALL}: {F.YELLOW}uploaded{F.RESET}")
+        print_tree_changes(self.local_dir, changes)
+        return changes
 
 
 __all__ = (
     "GetFile",
     "PutFile",
     "PutTemplate",
+    "PutDirectory",
+    "GetDirectory",
 )